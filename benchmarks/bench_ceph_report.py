@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# Compares ceph_monitoring.read_report, which folds pgmap.pg_stats into a
+# histogram of PG states as it streams the report, with decoding the whole
+# report with json.loads. A synthetic report of N PGs (100000 by default)
+# is written to a temporary file; each decoder then runs in a process of
+# its own so that the growth in peak RSS is its alone.
+#
+#     python benchmarks/bench_ceph_report.py [pgs]
+from __future__ import print_function
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+sys.modules['collectd'] = types.ModuleType('collectd')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'vanecloud'))
+
+import ceph_monitoring  # noqa
+
+STATES = ['active+clean'] * 8 + ['active+clean+scrubbing',
+                                 'active+undersized+degraded']
+
+
+def pg_stat(i):
+    return {'pgid': '%d.%x' % (i % 16, i),
+            'version': '%d\'%d' % (i % 97, i),
+            'reported_seq': str(i * 3),
+            'reported_epoch': str(i % 5000),
+            'state': STATES[i % len(STATES)],
+            'last_fresh': '2016-01-01 00:00:00.000000',
+            'last_change': '2016-01-01 00:00:00.000000',
+            'last_active': '2016-01-01 00:00:00.000000',
+            'last_clean': '2016-01-01 00:00:00.000000',
+            'log_size': 3000,
+            'ondisk_log_size': 3000,
+            'stat_sum': {'num_bytes': i * 4096, 'num_objects': i % 1000,
+                         'num_read': i * 7, 'num_write': i * 5,
+                         'num_read_kb': i * 28, 'num_write_kb': i * 20},
+            'up': [i % 100, (i + 1) % 100, (i + 2) % 100],
+            'acting': [i % 100, (i + 1) % 100, (i + 2) % 100],
+            'up_primary': i % 100,
+            'acting_primary': i % 100}
+
+
+def write_report(path, pgs):
+    with open(path, 'w') as report:
+        report.write('{"cluster_fingerprint": "bench", "version": "10.2.0", '
+                     '"health": {"overall_status": "HEALTH_OK"}, '
+                     '"pgmap": {"version": 1, "pg_stats": [')
+        for i in range(pgs):
+            if i:
+                report.write(', ')
+            json.dump(pg_stat(i), report)
+        report.write('], "pool_stats": []}, "osdmap": {"epoch": 1}}')
+
+
+def run(decoder, path):
+    """Decode path with decoder and print seconds, RSS growth and states."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    with open(path) as stream:
+        if decoder == 'read_report':
+            states = ceph_monitoring.read_report(stream)['pgmap']['pg_states']
+        else:
+            report = json.loads(stream.read())
+            states = {}
+            for pg in report['pgmap']['pg_stats']:
+                states[pg['state']] = states.get(pg['state'], 0) + 1
+    elapsed = time.time() - start
+    grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    print(json.dumps([elapsed, grown, dict(states)]))
+
+
+def main(pgs):
+    fd, path = tempfile.mkstemp(prefix='ceph_report.', suffix='.json')
+    os.close(fd)
+    try:
+        write_report(path, pgs)
+        print('%d PGs, %d byte report' % (pgs, os.path.getsize(path)))
+        print('%-12s %10s %12s' % ('decoder', 'seconds', 'rss KiB'))
+        results = {}
+        for decoder in ['json.loads', 'read_report']:
+            output = subprocess.check_output([sys.executable,
+                                              os.path.abspath(__file__),
+                                              '--run', decoder, path])
+            elapsed, grown, states = json.loads(output)
+            results[decoder] = states
+            print('%-12s %10.2f %12d' % (decoder, elapsed, grown))
+        assert results['json.loads'] == results['read_report']
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        run(sys.argv[2], sys.argv[3])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# Measures what get_cinder_client costs to validate a freshly built client
+# against a stub cinder API holding N volumes. The validation lists a single
+# non-detailed volume, so time and bytes per call should stay flat as N grows;
+# the full listing the client used to do is timed alongside for comparison.
+#
+# Needs python-cinderclient; collectd and keystone are stubbed out.
+#
+#     python benchmarks/bench_cinder_client.py [N ...]
+from __future__ import print_function
+
+import BaseHTTPServer
+import json
+import os
+import sys
+import threading
+import time
+import types
+import urlparse
+
+sys.modules['collectd'] = types.ModuleType('collectd')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'vanecloud'))
+
+import maas_common  # noqa
+
+ROUNDS = 20
+TOKEN = 'benchmark-token'
+
+
+class FakeCinder(BaseHTTPServer.BaseHTTPRequestHandler):
+    volumes = []
+    sent = [0]
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if self.headers.get('X-Auth-Token') != TOKEN:
+            return self.reply(401, {'error': 'unauthorized'})
+        if not url.path.endswith('/volumes'):
+            return self.reply(404, {'error': 'not found'})
+        start = 0
+        if 'marker' in query:
+            start = int(query['marker'].rsplit('-', 1)[1]) + 1
+        limit = int(query.get('limit', 1000))
+        self.reply(200, {'volumes': self.volumes[start:start + limit]})
+
+    def reply(self, code, body):
+        body = json.dumps(body)
+        self.sent[0] += len(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeKeystone(object):
+    auth_token = TOKEN
+
+
+def stub_keystone():
+    maas_common.get_auth_ref = lambda: {'token': {'id': TOKEN}}
+    maas_common.get_auth_details = lambda: {'OS_API_INSECURE': False,
+                                            'OS_ENDPOINT_TYPE': 'publicURL'}
+    maas_common.get_keystone_client = lambda *args, **kwargs: FakeKeystone()
+    maas_common.get_token_expiry = lambda auth_ref: time.time() + 3600
+
+
+def timed(func):
+    FakeCinder.sent[0] = 0
+    start = time.time()
+    for _ in range(ROUNDS):
+        func()
+    return ((time.time() - start) / ROUNDS * 1000,
+            FakeCinder.sent[0] // ROUNDS)
+
+
+def main(counts):
+    stub_keystone()
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FakeCinder)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    endpoint = 'http://127.0.0.1:%d/v2/tenant' % server.server_port
+
+    def validate():
+        maas_common.invalidate_clients()
+        maas_common.get_cinder_client(endpoint=endpoint)
+
+    def full_listing():
+        cinder = maas_common.get_cinder_client(endpoint=endpoint)
+        [i.id for i in cinder.volumes.list(detailed=False)]
+
+    print('%10s %14s %14s %14s %14s' % ('volumes', 'validate ms',
+                                        'validate B', 'listing ms',
+                                        'listing B'))
+    for count in counts:
+        FakeCinder.volumes = [{'id': 'volume-%d' % i, 'name': 'vol%d' % i,
+                               'links': []} for i in range(count)]
+        validate_ms, validate_bytes = timed(validate)
+        listing_ms, listing_bytes = timed(full_listing)
+        print('%10d %14.2f %14d %14.2f %14d' % (count, validate_ms,
+                                                validate_bytes, listing_ms,
+                                                listing_bytes))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [100, 1000, 10000, 100000])
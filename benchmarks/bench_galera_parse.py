@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Times galera_check's parse of mysql client output for the full SHOW
+# GLOBAL STATUS and SHOW GLOBAL VARIABLES result sets, which the check
+# used to read every poll, against the filtered ones it reads now: the
+# named status rows each poll and the named variables only when they are
+# refetched. The client is stubbed with canned tab-separated output shaped
+# like a Galera node's, so neither mysql nor MySQLdb is needed.
+#
+#     python benchmarks/bench_galera_parse.py [rounds]
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+import types
+
+sys.modules['collectd'] = types.ModuleType('collectd')
+sys.modules['collectd'].register_config = lambda *args: None
+sys.modules['collectd'].register_read = lambda *args: None
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'vanecloud'))
+
+import galera_check  # noqa
+
+# roughly how many rows a PXC 5.7 node returns for each
+STATUS_ROWS = 480
+VARIABLE_ROWS = 620
+
+
+def client_output(rows):
+    return 'Variable_name\tValue\n%s\n' % '\n'.join(
+        '%s\t%s' % row for row in rows)
+
+
+def status_rows():
+    rows = [(name, '1') for name in galera_check.STATUS_NAMES]
+    rows += [('Com_stmt_%d' % i, str(i * 7919)) for i in
+             range(STATUS_ROWS - len(rows))]
+    return rows
+
+
+def variable_rows():
+    rows = [(name, '4096') for name in galera_check.VARIABLE_NAMES]
+    # a few variables carry long values, like optimizer_switch
+    rows += [('optimizer_switch_%d' % i, ','.join(['index_merge=on'] * 20))
+             for i in range(20)]
+    rows += [('innodb_setting_%d' % i, 'OFF') for i in
+             range(VARIABLE_ROWS - len(rows))]
+    return rows
+
+
+def parse(output):
+    """Stub the client with output and parse one result set."""
+    galera_check.galera_check = lambda arg: (0, output, '')
+    return dict(galera_check.query_mysql('SHOW'))
+
+
+def main(rounds):
+    galera_check.MySQLdb = None
+    galera_check.CONFIGS.update(ip=None, port=None)
+
+    status = status_rows()
+    variables = variable_rows()
+    names = set(galera_check.STATUS_NAMES + galera_check.VARIABLE_NAMES)
+    full_status = client_output(status)
+    full_variables = client_output(variables)
+    named_status = client_output([row for row in status if row[0] in names])
+    named_variables = client_output([row for row in variables
+                                     if row[0] in names])
+
+    def full():
+        # every row of both, then picking out the ones that are reported
+        rows = parse(full_status)
+        rows.update(parse(full_variables))
+        return dict((name, rows[name]) for name in names)
+
+    cases = [('full status + variables', full,
+              len(full_status) + len(full_variables)),
+             ('named status', lambda: parse(named_status),
+              len(named_status)),
+             ('named variables', lambda: parse(named_variables),
+              len(named_variables))]
+
+    print('%-26s %12s %12s' % ('result set', 'bytes', 'us per poll'))
+    for label, func, size in cases:
+        seconds = min(timeit.repeat(func, number=rounds, repeat=5))
+        print('%-26s %12d %12.1f' % (label, size, seconds / rounds * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
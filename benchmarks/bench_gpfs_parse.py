@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+# Times gpfs_check's disk status parse of a synthetic N-disk mmlsdisk -Y
+# dump (5000 by default), through parse_y, against the loop it replaced,
+# which split every line once per field it read. The command is stubbed
+# with the canned dump, so GPFS isn't needed.
+#
+#     python benchmarks/bench_gpfs_parse.py [disks [rounds]]
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+import types
+
+sys.modules['collectd'] = types.ModuleType('collectd')
+sys.modules['collectd'].register_config = lambda *args: None
+sys.modules['collectd'].register_read = lambda *args: None
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'vanecloud'))
+
+import gpfs_check  # noqa
+
+COLUMNS = ['nsdName', 'driverType', 'sectorSize', 'failureGroup',
+           'metadata', 'data', 'status', 'availability', 'diskID',
+           'storagePool', 'remarks', 'numQuorumDisks', 'readQuorumValue',
+           'writeQuorumValue', 'diskSizeKB', 'diskUID', '']
+STATUSES = ['ready', 'ready', 'ready', 'suspended', 'down']
+
+
+def mmlsdisk_dump(disks):
+    lines = [':'.join(['mmlsdisk', '', 'HEADER', 'version', 'reserved',
+                       'reserved'] + COLUMNS)]
+    for i in range(disks):
+        lines.append(':'.join([
+            'mmlsdisk', '', '0', '1', '', '', 'nsd%05d' % i, 'nsd', '512',
+            str(i % 8), 'Yes', 'Yes', STATUSES[i % len(STATUSES)], 'up',
+            str(i + 1), 'system', '', '', '', '', '1073741824',
+            'C0A80001%016X' % i, '']))
+    return '\n'.join(lines) + '\n'
+
+
+def split_per_field(fdd):
+    """The disk status parse before parse_y, kept for comparison."""
+    metrics = {}
+    for line in fdd.splitlines()[1:]:
+        disk_name = line.split(':')[6]
+        if line.split(':')[12] == 'down':
+            disk_status = 0
+        elif line.split(':')[12] == 'ready':
+            disk_status = 1
+        elif line.split(':')[12] == 'suspended':
+            disk_status = 2
+        else:
+            disk_status = 3
+        metrics['disk.' + disk_name + '_status'] = disk_status
+    return metrics
+
+
+def main(disks, rounds):
+    dump = mmlsdisk_dump(disks)
+    gpfs = gpfs_check.GPFS()
+    gpfs._output = lambda cmd: dump
+
+    def with_parse_y():
+        gpfs.metrics = {}
+        gpfs._get_gpfs_disk_status('fs1')
+        return gpfs.metrics
+
+    assert with_parse_y() == split_per_field(dump)
+
+    print('%d disks, %d bytes' % (disks, len(dump)))
+    print('%-18s %12s' % ('parser', 'ms per dump'))
+    for label, func in [('split per field', lambda: split_per_field(dump)),
+                        ('parse_y', with_parse_y)]:
+        seconds = min(timeit.repeat(func, number=rounds, repeat=5))
+        print('%-18s %12.2f' % (label, seconds / rounds * 1000))
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [5000, 20][len(args):]))
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# Runs nova_api_local_check's server sync against a stub nova holding N
+# servers (100000 by default). Like nova, the stub caps limit at
+# osapi_max_limit and only links a next page from a full one, so asking for
+# pages bigger than the cap must still count every server. A full sync and
+# an incremental one over a handful of changes are timed, with the number
+# of requests, bytes read and the growth in peak RSS.
+#
+# Needs requests; collectd and keystone are stubbed out.
+#
+#     python benchmarks/bench_nova_servers.py [N [page_size [max_limit]]]
+from __future__ import print_function
+
+import BaseHTTPServer
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import types
+import urllib
+import urlparse
+
+sys.modules['collectd'] = types.ModuleType('collectd')
+sys.modules['collectd'].register_config = lambda *args: None
+sys.modules['collectd'].register_read = lambda *args: None
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'vanecloud'))
+
+import nova_api_local_check as nova_check  # noqa
+
+TOKEN = 'benchmark-token'
+STATUSES = ['ACTIVE', 'ACTIVE', 'ACTIVE', 'STOPPED', 'ERROR']
+CHANGES = 50
+
+
+def server(i):
+    return {'id': 'server-%08d' % i,
+            'name': 'instance-%08d' % i,
+            'status': STATUSES[i % len(STATUSES)],
+            'tenant_id': 'tenant-%d' % (i % 97),
+            'user_id': 'user-%d' % (i % 31),
+            'flavor': {'id': '2', 'links': []},
+            'image': {'id': 'image-%d' % (i % 13), 'links': []},
+            'addresses': {'private': [{'addr': '10.%d.%d.%d'
+                                       % (i >> 16 & 255, i >> 8 & 255,
+                                          i & 255), 'version': 4}]},
+            'metadata': {},
+            'updated': '2016-01-01T00:00:00Z',
+            'links': []}
+
+
+class FakeNova(BaseHTTPServer.BaseHTTPRequestHandler):
+    count = 0
+    max_limit = 1000
+    requests = [0]
+    sent = [0]
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if self.headers.get('X-Auth-Token') != TOKEN:
+            return self.reply(401, {'error': 'unauthorized'})
+        if url.path.endswith('/os-services'):
+            return self.reply(200, {'services': []})
+        if not url.path.endswith('/servers/detail'):
+            return self.reply(404, {'error': 'not found'})
+
+        limit = min(int(query.get('limit', self.max_limit)), self.max_limit)
+        start = 0
+        if 'changes-since' in query:
+            # only the last few servers changed
+            start = self.count - CHANGES
+        if 'marker' in query:
+            start = int(query['marker'].rsplit('-', 1)[1]) + 1
+        ids = range(start, min(start + limit, self.count))
+        body = {'servers': [server(i) for i in ids]}
+        if 'changes-since' in query and ids and ids[-1] == self.count - 1:
+            # and the very last one was deleted
+            body['servers'][-1]['status'] = 'DELETED'
+        if len(ids) == limit:
+            query.update(limit=limit, marker=body['servers'][-1]['id'])
+            body['servers_links'] = [{
+                'rel': 'next',
+                'href': 'http://nova.example.com%s?%s'
+                        % (url.path, urllib.urlencode(query))}]
+        self.reply(200, body)
+
+    def reply(self, code, body):
+        body = json.dumps(body)
+        self.requests[0] += 1
+        self.sent[0] += len(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def timed(label, func):
+    FakeNova.requests[0] = FakeNova.sent[0] = 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    counts = func()
+    elapsed = time.time() - start
+    grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    print('%-12s %10d %10.2f %10d %12d %10d' % (
+        label, sum(counts.values()), elapsed, FakeNova.requests[0],
+        FakeNova.sent[0], grown))
+
+
+def main(count, page_size, max_limit):
+    FakeNova.count = count
+    FakeNova.max_limit = max_limit
+    server_ = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FakeNova)
+    thread = threading.Thread(target=server_.serve_forever)
+    thread.daemon = True
+    thread.start()
+    endpoint = 'http://127.0.0.1:%d/v2/tenant' % server_.server_port
+
+    nova_check.CONFIGS.update(incremental_sync=True, full_sync_interval=3600,
+                              page_size=page_size)
+
+    print('%d servers, page_size %d, osapi_max_limit %d'
+          % (count, page_size, max_limit))
+    print('%-12s %10s %10s %10s %12s %10s' % ('sync', 'servers', 'seconds',
+                                              'requests', 'bytes',
+                                              'rss KiB'))
+    timed('full', lambda: nova_check.sync_servers(TOKEN, endpoint))
+    timed('incremental', lambda: nova_check.sync_servers(TOKEN, endpoint))
+    server_.shutdown()
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [100000, 5000, 1000][len(args):]))
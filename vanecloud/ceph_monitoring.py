@@ -15,12 +15,41 @@
 # limitations under the License.
 
 import argparse
+import collections
+import errno
+import fcntl
 import json
 import maas_common
+from multiprocessing.pool import ThreadPool
+import os
+import re
 import subprocess
+import tempfile
+import time
 
 
 STATUSES = {'HEALTH_OK': 2, 'HEALTH_WARN': 1, 'HEALTH_ERR': 0}
+# PG states always reported, even when no PG is in them
+PG_STATES = ['active', 'clean', 'peering', 'degraded', 'undersized',
+             'remapped', 'backfilling', 'backfill_wait', 'backfill_toofull',
+             'recovering', 'recovery_wait', 'stale', 'down', 'incomplete',
+             'inconsistent', 'scrubbing']
+PG_STATS = re.compile(r'"pg_stats"\s*:\s*\[')
+PG_STATS_SEPARATORS = re.compile(r'[\s,]*')
+READ_SIZE = 64 * 1024
+# the ceph commands each subcommand's statistics are drawn from
+COMMANDS = {'health': ('health',),
+            'quorum_status': ('quorum_status',),
+            'osd_dump': ('osd', 'dump'),
+            'osd_df': ('osd', 'df'),
+            'pg_stat': ('pg', 'stat')}
+SOURCES = {'mon': ['quorum_status', 'health'],
+           'osd': ['osd_dump', 'osd_df'],
+           'cluster': ['health', 'quorum_status', 'osd_dump', 'osd_df',
+                       'pg_stat']}
+# command output is shared by the checks run on a host within CACHE_TTL
+CACHE_DIR = '/var/lib/vanecloud/ceph'
+CACHE_TTL = 10
 
 
 def check_command(command):
@@ -29,28 +58,200 @@ def check_command(command):
     return json.loads(lines[-1])
 
 
+def read_report(stream):
+    """Decode a JSON ceph report from stream, without pgmap.pg_stats.
+
+    pg_stats holds one object per PG, which is most of the report on large
+    clusters. Its elements are decoded one at a time as the report is read
+    and only their states are kept, so the list is never built. The report
+    is returned with pgmap.pg_states, a Counter of PGs by state, in place
+    of pg_stats.
+    """
+    decoder = json.JSONDecoder()
+    kept = []
+    buf = ''
+    pg_states = collections.Counter()
+
+    match = PG_STATS.search(buf)
+    while match is None:
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            break
+        # hold back a tail in case the key straddles two chunks
+        kept.append(buf[:-64])
+        buf = buf[-64:] + chunk
+        match = PG_STATS.search(buf)
+
+    if match is not None:
+        kept.append(buf[:match.end()])
+        buf = buf[match.end():]
+        pos = 0
+        while True:
+            pos = PG_STATS_SEPARATORS.match(buf, pos).end()
+            if pos < len(buf) and buf[pos] == ']':
+                break
+            try:
+                if pos == len(buf):
+                    raise ValueError('Need more data')
+                pg, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                chunk = stream.read(READ_SIZE)
+                if not chunk:
+                    raise ValueError('Truncated pg_stats in ceph report')
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            pg_states[pg['state']] += 1
+        buf = buf[pos:]
+
+    kept.append(buf)
+    kept.append(stream.read())
+    report = json.loads(''.join(kept))
+    if 'pgmap' in report:
+        report['pgmap'].pop('pg_stats', None)
+        report['pgmap']['pg_states'] = pg_states
+    return report
+
+
 def get_ceph_report(client, keyring, fmt='json'):
-    return check_command(('ceph', '--format', fmt, '--name', client,
-                          '--keyring', keyring, 'report'))
+    command = ('ceph', '--format', fmt, '--name', client,
+               '--keyring', keyring, 'report')
+    error = None
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                stderr=stderr)
+        try:
+            report = read_report(proc.stdout)
+        except ValueError as e:
+            error = e
+            # let ceph finish writing before reaping it
+            proc.stdout.read()
+        proc.stdout.close()
+        retcode = proc.wait()
+        if retcode:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(retcode, command,
+                                                output=stderr.read())
+    if error is not None:
+        raise error
+    return report
+
+
+def make_cache_dir():
+    try:
+        os.makedirs(CACHE_DIR)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def read_cache(path, cache_ttl):
+    """Return the output cached at path, or None if it is missing or stale."""
+    try:
+        if time.time() - os.path.getmtime(path) < cache_ttl:
+            with open(path) as cache_file:
+                return json.load(cache_file)
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def write_cache(path, output):
+    """Atomically replace the cached output at path."""
+    make_cache_dir()
+    fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, prefix='.cache.')
+    try:
+        with os.fdopen(fd, 'w') as cache_file:
+            json.dump(output, cache_file)
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
 
+def get_ceph_output(client, keyring, source, cache_ttl=CACHE_TTL,
+                    fmt='json'):
+    """Return the decoded output of COMMANDS[source].
 
-def get_mon_statistics(report=None, host=None):
-    mon = [m for m in report['monmap']['mons']
+    Output less than cache_ttl seconds old is read from CACHE_DIR instead
+    of running ceph again. Checks started together would all miss the
+    cache, so they queue on an flock of the source's lock file: whoever
+    gets there first runs ceph and the rest read its output. Failing to
+    use the cache or the lock is not an error.
+    """
+    path = os.path.join(CACHE_DIR, '%s.%s.json' % (client, source))
+    output = read_cache(path, cache_ttl)
+    if output is not None:
+        return output
+
+    try:
+        make_cache_dir()
+        lock_file = open(path + '.lock', 'a')
+    except (IOError, OSError):
+        lock_file = None
+    try:
+        if lock_file is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            output = read_cache(path, cache_ttl)
+            if output is not None:
+                return output
+
+        output = check_command(('ceph', '--format', fmt, '--name', client,
+                                '--keyring', keyring) + COMMANDS[source])
+        try:
+            write_cache(path, output)
+        except (IOError, OSError):
+            pass
+        return output
+    finally:
+        if lock_file is not None:
+            lock_file.close()
+
+
+def get_sources(client, keyring, sources, cache_ttl=CACHE_TTL):
+    """Return {source: output}, running the ceph commands concurrently."""
+    pool = ThreadPool(len(sources))
+    try:
+        outputs = pool.map(lambda source: get_ceph_output(client, keyring,
+                                                          source, cache_ttl),
+                           sources)
+    finally:
+        pool.close()
+    return dict(zip(sources, outputs))
+
+
+def get_pg_states(pg_stat, client, keyring):
+    """Return a Counter of PGs by state.
+
+    pg stat counts them already; on releases where it does not, the
+    pg_stats of a full report are folded instead.
+    """
+    summary = pg_stat.get('pg_summary', pg_stat)
+    if 'num_pg_by_state' in summary:
+        return collections.Counter(dict((state['name'], state['num'])
+                                        for state in
+                                        summary['num_pg_by_state']))
+    return get_ceph_report(client, keyring)['pgmap']['pg_states']
+
+
+def get_mon_statistics(sources=None, host=None):
+    quorum_status = sources['quorum_status']
+    mon = [m for m in quorum_status['monmap']['mons']
            if m['name'] == host]
-    mon_in = mon[0]['rank'] in report['quorum']
+    mon_in = mon[0]['rank'] in quorum_status['quorum']
     maas_common.metric_bool('mon_in_quorum', mon_in)
     health_status = 0
-    for each in report['health']['health']['health_services'][0]['mons']:
+    for each in sources['health']['health']['health_services'][0]['mons']:
         if each['name'] == host:
             health_status = STATUSES[each['health']]
             break
     maas_common.metric('mon_health', 'uint32', health_status)
 
 
-def get_osd_statistics(report=None, osd_ids=None):
+def get_osd_statistics(sources=None, osd_ids=None):
     for osd_id in osd_ids:
         osd_ref = 'osd.%s' % osd_id
-        for _osd in report['osdmap']['osds']:
+        for _osd in sources['osd_dump']['osds']:
             if _osd['osd'] == osd_id:
                 osd = _osd
                 break
@@ -61,8 +262,8 @@ def get_osd_statistics(report=None, osd_ids=None):
             name = '_'.join((osd_ref, key))
             maas_common.metric_bool(name, osd[key])
 
-        for _osd in report['pgmap']['osd_stats']:
-            if _osd['osd'] == osd_id:
+        for _osd in sources['osd_df']['nodes']:
+            if _osd['id'] == osd_id:
                 osd = _osd
                 break
         for key in ('kb', 'kb_used', 'kb_avail'):
@@ -70,23 +271,25 @@ def get_osd_statistics(report=None, osd_ids=None):
             maas_common.metric(name, 'uint64', osd[key])
 
 
-def get_cluster_statistics(report=None):
+def get_cluster_statistics(sources=None, pg_states=None):
     metrics = []
 
     # Get overall cluster health
     metrics.append({'name': 'cluster_health',
                     'type': 'uint32',
-                    'value': STATUSES[report['health']['overall_status']]})
+                    'value': STATUSES[sources['health']['overall_status']]})
 
     # Collect epochs for the mon and osd maps
-    for map_name in ('monmap', 'osdmap'):
-        metrics.append({'name': "%(map)s_epoch" % {'map': map_name},
-                        'type': 'uint32',
-                        'value': report[map_name]['epoch']})
+    metrics.append({'name': 'monmap_epoch',
+                    'type': 'uint32',
+                    'value': sources['quorum_status']['monmap']['epoch']})
+    metrics.append({'name': 'osdmap_epoch',
+                    'type': 'uint32',
+                    'value': sources['osd_dump']['epoch']})
 
     # Collect OSDs per state
     osds = {'total': 0, 'up': 0, 'in': 0}
-    for osd in report['osdmap']['osds']:
+    for osd in sources['osd_dump']['osds']:
         osds['total'] += 1
         if osd['up'] == 1:
             osds['up'] += 1
@@ -99,18 +302,20 @@ def get_cluster_statistics(report=None):
 
     # Collect cluster size & utilisation
     osds_stats = ('kb', 'kb_avail', 'kb_used')
-    for k in report['pgmap']['osd_stats_sum']:
-        if k in osds_stats:
-            metrics.append({'name': 'osds_%s' % k,
-                            'type': 'uint64',
-                            'value': report['pgmap']['osd_stats_sum'][k]})
-
-    # Collect num PGs and num healthy PGs
-    pgs = {'total': 0, 'active_clean': 0}
-    for pg in report['pgmap']['pg_stats']:
-        pgs['total'] += 1
-        if pg['state'] == 'active+clean':
-            pgs['active_clean'] += 1
+    for k in osds_stats:
+        metrics.append({'name': 'osds_%s' % k,
+                        'type': 'uint64',
+                        'value': sources['osd_df']['summary']['total_%s' % k]})
+
+    # Collect num PGs, num healthy PGs and num PGs in each state; a PG
+    # in e.g. active+degraded+backfilling counts towards all three
+    pgs = {'total': sum(pg_states.values()),
+           'active_clean': pg_states['active+clean']}
+    for state in PG_STATES:
+        pgs[state] = 0
+    for states, count in pg_states.items():
+        for state in states.split('+'):
+            pgs[state] = pgs.get(state, 0) + count
     for k in pgs:
         metrics.append({'name': 'pgs_%s' % k,
                         'type': 'uint32',
@@ -125,6 +330,8 @@ def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--name', required=True, help='Ceph client name')
     parser.add_argument('--keyring', required=True, help='Ceph client keyring')
+    parser.add_argument('--cache_ttl', type=float, default=CACHE_TTL,
+                        help='Seconds ceph output is shared between checks')
 
     subparsers = parser.add_subparsers(dest='subparser_name')
 
@@ -143,8 +350,12 @@ def main(args):
     get_statistics = {'cluster': get_cluster_statistics,
                       'mon': get_mon_statistics,
                       'osd': get_osd_statistics}
-    report = get_ceph_report(client=args.name, keyring=args.keyring)
-    kwargs = {'report': report}
+    sources = get_sources(args.name, args.keyring,
+                          SOURCES[args.subparser_name], args.cache_ttl)
+    kwargs = {'sources': sources}
+    if args.subparser_name == 'cluster':
+        kwargs['pg_states'] = get_pg_states(sources['pg_stat'], args.name,
+                                            args.keyring)
     if args.subparser_name == 'osd':
         kwargs['osd_ids'] = [int(i) for i in args.osd_ids.split(' ')]
     if args.subparser_name == 'mon':
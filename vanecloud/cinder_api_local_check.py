@@ -15,22 +15,33 @@
 # limitations under the License.
 
 import collections
+import time
 
 # Technically maas_common isn't third-party but our own thing but hacking
 # consideres it third-party
+from maas_common import APIRequest
+from maas_common import configure_graphite
+from maas_common import count_listing
+from maas_common import flush_metrics
+from maas_common import get_api_poller
 from maas_common import get_auth_ref
 from maas_common import get_keystone_client
 from maas_common import metric
 from maas_common import metric_bool
+from maas_common import next_page
+from maas_common import run_in_background
 from maas_common import status_err
 from maas_common import status_ok
-import requests
+from maas_common import SPOOL_MAX_BYTES
 from requests import exceptions as exc
 import collectd
 
 CONFIGS = {}
 VOLUME_STATUSES = ['available', 'in-use', 'error']
 PLUGIN = 'cinder_api_local_check'
+COUNT_MODES = ['detail', 'server']
+# with_count on listings arrived in volume API microversion 3.45
+COUNT_MICROVERSION = {'OpenStack-API-Version': 'volume 3.45'}
 
 # NOTE(mancdaz): until https://review.openstack.org/#/c/111051/
 # lands, there is no way to pass a custom (local) endpoint to
@@ -41,8 +52,13 @@ def configure_callback(conf):
     """Receive configuration block"""
     ip = None
     interval = 10
+    timeout = 10
     graphite_host = None
     graphite_port = None
+    graphite_protocol = 'plaintext'
+    graphite_spool_size = SPOOL_MAX_BYTES
+    page_size = 1000
+    count_mode = 'detail'
 
     for node in conf.children:
         key = node.key
@@ -52,21 +68,120 @@ def configure_callback(conf):
             ip = val
         elif key == 'interval':
             interval = val
+        elif key == 'timeout':
+            timeout = val
         elif key == 'graphite_host':
             graphite_host = val
         elif key == 'graphite_port':
             graphite_port = val
+        elif key == 'graphite_protocol':
+            graphite_protocol = val
+        elif key == 'graphite_spool_size':
+            graphite_spool_size = val
+        elif key == 'page_size':
+            page_size = int(val)
+        elif key == 'count_mode':
+            count_mode = val
         else:
             collectd.warning('cinder_api_local_check: Unknown config key: {}'
                              .format(key))
             continue
 
+    if count_mode not in COUNT_MODES:
+        collectd.warning('cinder_api_local_check: Unknown count_mode: {}, '
+                         'using detail'.format(count_mode))
+        count_mode = 'detail'
+
     auth_ref = get_auth_ref()
     CONFIGS['ip'] = ip
     CONFIGS['auth_ref'] = auth_ref
     CONFIGS['interval'] = interval
+    CONFIGS['timeout'] = timeout
     CONFIGS['graphite_host'] = graphite_host
     CONFIGS['graphite_port'] = graphite_port
+    CONFIGS['page_size'] = page_size
+    CONFIGS['count_mode'] = count_mode
+    configure_graphite(graphite_host, graphite_port, graphite_protocol,
+                       graphite_spool_size)
+
+
+def summarise(key):
+    """Build a reducer counting statuses of the items listed under key.
+
+    The reducer follows the pagination links from the first response and
+    decodes each page exactly once, keeping only the counters, so memory
+    is bounded by page_size rather than by the number of volumes.
+    """
+    def reducer(response):
+        summary = {'ok': response.ok,
+                   'milliseconds': response.elapsed.total_seconds() * 1000,
+                   'statuses': collections.Counter(),
+                   'total': 0}
+        params = {'limit': CONFIGS['page_size']}
+        while response.ok:
+            body = response.json()
+            items = body[key]
+            summary['statuses'].update(item['status'] for item in items)
+            summary['total'] += len(items)
+            params = next_page(body, key, params)
+            if params is None:
+                break
+            response = get_api_poller().follow(response, params)
+            summary['ok'] = response.ok
+        return summary
+    return reducer
+
+
+def poll_detail(auth_token, tenant_id):
+    """Count statuses by listing every volume and snapshot in detail."""
+    endpoint = ('http://{ip}:8776/v2/{tenant}'.format
+                (ip=CONFIGS['ip'], tenant=tenant_id))
+    page = {'limit': CONFIGS['page_size']}
+    polled = get_api_poller().poll(auth_token, [
+        APIRequest('volumes', '%s/volumes/detail' % endpoint,
+                   page, summarise('volumes')),
+        APIRequest('snapshots', '%s/snapshots/detail' % endpoint,
+                   page, summarise('snapshots'))
+    ], timeout=10)
+    return polled['volumes'], polled['snapshots']
+
+
+def poll_server(auth_token, tenant_id):
+    """Count statuses with one filtered, server-side counted query each.
+
+    Every query asks for a single summary item plus the total matching its
+    status filter, so a cycle transfers a few hundred bytes per status
+    whatever the number of volumes.
+    """
+    endpoint = ('http://{ip}:8776/v3/{tenant}'.format
+                (ip=CONFIGS['ip'], tenant=tenant_id))
+    api_requests = []
+    for key in ['volumes', 'snapshots']:
+        reducer = count_listing(key, CONFIGS['page_size'])
+        url = '%s/%s' % (endpoint, key)
+        api_requests.append(APIRequest(key, url,
+                                       {'limit': 1, 'with_count': True},
+                                       reducer, COUNT_MICROVERSION))
+        for status in VOLUME_STATUSES:
+            api_requests.append(APIRequest('%s_%s' % (key, status), url,
+                                           {'status': status, 'limit': 1,
+                                            'with_count': True},
+                                           reducer, COUNT_MICROVERSION))
+
+    start = time.time()
+    polled = get_api_poller().poll(auth_token, api_requests, timeout=10)
+    milliseconds = (time.time() - start) * 1000
+
+    summaries = []
+    for key in ['volumes', 'snapshots']:
+        counts = [polled[key]] + [polled['%s_%s' % (key, status)]
+                                  for status in VOLUME_STATUSES]
+        summaries.append({'ok': None not in counts,
+                          'milliseconds': milliseconds,
+                          'statuses': collections.Counter(
+                              dict(zip(VOLUME_STATUSES, counts[1:]))),
+                          'total': counts[0]})
+    return summaries
 
 
 def check():
@@ -74,24 +189,14 @@ def check():
         keystone = get_keystone_client(CONFIGS['auth_ref'])
         auth_token = keystone.auth_token
 
-        VOLUME_ENDPOINT = ('http://{ip}:8776/v1/{tenant}'.format
-                           (ip=CONFIGS['ip'], tenant=keystone.tenant_id))
-
-        s = requests.Session()
-
-        s.headers.update(
-            {'Content-type': 'application/json',
-             'x-auth-token': auth_token})
+        if CONFIGS['count_mode'] == 'server':
+            poll = poll_server
+        else:
+            poll = poll_detail
 
         try:
-            vol = s.get('%s/volumes/detail' % VOLUME_ENDPOINT,
-                        verify=False,
-                        timeout=10)
-            milliseconds = vol.elapsed.total_seconds() * 1000
-            snap = s.get('%s/snapshots/detail' % VOLUME_ENDPOINT,
-                         verify=False,
-                         timeout=10)
-            is_up = vol.ok and snap.ok
+            vol, snap = poll(auth_token, keystone.tenant_id)
+            is_up = vol['ok'] and snap['ok']
         except (exc.ConnectionError,
                 exc.HTTPError,
                 exc.Timeout) as e:
@@ -100,13 +205,12 @@ def check():
             status_err(str(e))
         else:
             # gather some metrics
-            vol_statuses = [v['status'] for v in vol.json()['volumes']]
-            vol_status_count = collections.Counter(vol_statuses)
-            total_vols = len(vol.json()['volumes'])
+            milliseconds = vol['milliseconds']
+            vol_status_count = vol['statuses']
+            total_vols = vol['total']
 
-            snap_statuses = [v['status'] for v in snap.json()['snapshots']]
-            snap_status_count = collections.Counter(snap_statuses)
-            total_snaps = len(snap.json()['snapshots'])
+            snap_status_count = snap['statuses']
+            total_snaps = snap['total']
 
         status_ok()
         metric_bool(PLUGIN, 'cinder_api_local_status', is_up,
@@ -142,7 +246,9 @@ def check():
                     graphite_host=CONFIGS['graphite_host'],
                     graphite_port=CONFIGS['graphite_port'])
         raise
+    finally:
+        flush_metrics()
 
 # register callbacks
 collectd.register_config(configure_callback)
-collectd.register_read(check)
+collectd.register_read(run_in_background(PLUGIN, check, CONFIGS))
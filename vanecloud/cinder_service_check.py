@@ -16,11 +16,15 @@
 
 # Technically maas_common isn't third-party but our own thing but hacking
 # consideres it third-party
+from maas_common import configure_graphite
+from maas_common import flush_metrics
 from maas_common import get_auth_ref
 from maas_common import get_keystone_client
 from maas_common import metric_bool
+from maas_common import run_in_background
 from maas_common import status_err
 from maas_common import status_ok
+from maas_common import SPOOL_MAX_BYTES
 import requests
 from requests import exceptions as exc
 
@@ -40,8 +44,11 @@ def configure_callback(conf):
     ip = None
     host = None
     interval = 10
+    timeout = 10
     graphite_host = None
     graphite_port = None
+    graphite_protocol = 'plaintext'
+    graphite_spool_size = SPOOL_MAX_BYTES
 
     for node in conf.children:
         key = node.key
@@ -51,12 +58,18 @@ def configure_callback(conf):
             ip = val
         elif key == 'interval':
             interval = val
+        elif key == 'timeout':
+            timeout = val
         elif key == 'host':  # Only return metrics for specified host
             host == host
         elif key == 'graphite_host':
             graphite_host = val
         elif key == 'graphite_port':
             graphite_port = val
+        elif key == 'graphite_protocol':
+            graphite_protocol = val
+        elif key == 'graphite_spool_size':
+            graphite_spool_size = val
         else:
             collectd.warning('cinder_service_check: Unknown config key: {}'
                              .format(key))
@@ -67,8 +80,11 @@ def configure_callback(conf):
     CONFIGS['host'] = host
     CONFIGS['auth_ref'] = auth_ref
     CONFIGS['interval'] = interval
+    CONFIGS['timeout'] = timeout
     CONFIGS['graphite_host'] = graphite_host
     CONFIGS['graphite_port'] = graphite_port
+    configure_graphite(graphite_host, graphite_port, graphite_protocol,
+                       graphite_spool_size)
 
 
 def check():
@@ -153,7 +169,9 @@ def check():
                     graphite_host=CONFIGS['graphite_host'],
                     graphite_port=CONFIGS['graphite_port'])
         raise
+    finally:
+        flush_metrics()
 
 # register callbacks
 collectd.register_config(configure_callback)
-collectd.register_read(check)
+collectd.register_read(run_in_background(PLUGIN, check, CONFIGS))
@@ -16,17 +16,49 @@
 import optparse
 import shlex
 import subprocess
+import time
 
 
+from maas_common import configure_graphite
+from maas_common import flush_metrics
 from maas_common import metric
 from maas_common import metric_bool
+from maas_common import run_in_background
 from maas_common import status_err
 from maas_common import status_ok
+from maas_common import SPOOL_MAX_BYTES
 
 import collectd
 
+try:
+    import MySQLdb
+except ImportError:
+    # fall back to the mysql client
+    MySQLdb = None
+
 CONFIGS = {}
 PLUGIN = 'galera_check'
+MYSQL_DEFAULTS_FILE = '/root/.my.cnf'
+STATUS_NAMES = ['wsrep_replicated_bytes', 'wsrep_received_bytes',
+                'wsrep_commit_window', 'wsrep_cluster_size',
+                'wsrep_cluster_status', 'wsrep_cluster_state_uuid',
+                'wsrep_local_state', 'wsrep_local_state_uuid',
+                'wsrep_local_state_comment', 'Queries',
+                'Threads_connected', 'Max_used_connections', 'Uptime']
+VARIABLE_NAMES = ['max_connections']
+# variables rarely change, so they are only refetched every variables_ttl
+# seconds or when Uptime goes backwards because the server restarted
+VARIABLES_CACHE = {'variables': None, 'fetched': 0, 'uptime': None}
+# the driver's connection, kept open between polls
+CONNECTION = {'conn': None}
+# counters reported as per-second rates, and the names they are sent as
+RATE_COUNTERS = {'Queries': 'queries_per_second',
+                 'wsrep_replicated_bytes': 'wsrep_replicated_bytes_per_second',
+                 'wsrep_received_bytes': 'wsrep_received_bytes_per_second'}
+# the previous (value, timestamp) sample of each counter
+RATE_SAMPLES = {}
+# time.monotonic is python 3 only
+monotonic = getattr(time, 'monotonic', time.time)
 
 
 def configure_callback(conf):
@@ -34,8 +66,12 @@ def configure_callback(conf):
     ip = None
     port = None
     interval = 10
+    timeout = 10
     graphite_host = None
     graphite_port = None
+    graphite_protocol = 'plaintext'
+    graphite_spool_size = SPOOL_MAX_BYTES
+    variables_ttl = 3600
 
     for node in conf.children:
         key = node.key
@@ -45,12 +81,20 @@ def configure_callback(conf):
             ip = val
         elif key == 'interval':
             interval = val
+        elif key == 'timeout':
+            timeout = val
         elif key == 'port':  # Only return metrics for specified host
-            port == val
+            port = val
         elif key == 'graphite_host':
             graphite_host = val
         elif key == 'graphite_port':
             graphite_port = val
+        elif key == 'graphite_protocol':
+            graphite_protocol = val
+        elif key == 'graphite_spool_size':
+            graphite_spool_size = val
+        elif key == 'variables_ttl':
+            variables_ttl = int(val)
         else:
             collectd.warning('galera_check: Unknown config key: {}'
                              .format(key))
@@ -59,8 +103,12 @@ def configure_callback(conf):
     CONFIGS['ip'] = ip
     CONFIGS['port'] = port
     CONFIGS['interval'] = interval
+    CONFIGS['timeout'] = timeout
     CONFIGS['graphite_host'] = graphite_host
     CONFIGS['graphite_port'] = graphite_port
+    CONFIGS['variables_ttl'] = variables_ttl
+    configure_graphite(graphite_host, graphite_port, graphite_protocol,
+                       graphite_spool_size)
 
 
 def galera_check(arg):
@@ -74,7 +122,7 @@ def galera_check(arg):
     return ret, out, err
 
 
-def generate_query(host, port, output_type='status'):
+def generate_query(host, port, query):
     if host:
         host = ' -h %s' % host
     else:
@@ -84,12 +132,118 @@ def generate_query(host, port, output_type='status'):
         port = ' -P %s' % port
     else:
         port = ''
-    if output_type == 'status':
-        return ('/usr/bin/mysql --defaults-file=/root/.my.cnf '
-                '%s%s -e "SHOW GLOBAL STATUS"') % (host, port)
-    elif output_type == 'variables':
-        return ('/usr/bin/mysql --defaults-file=/root/.my.cnf '
-                '%s%s -e "SHOW GLOBAL VARIABLES"') % (host, port)
+    return ('/usr/bin/mysql --defaults-file=%s '
+            '%s%s -e "%s"') % (MYSQL_DEFAULTS_FILE, host, port, query)
+
+
+def generate_show(kind, variables):
+    """Show only the named global STATUS or VARIABLES rows.
+
+    information_schema's GLOBAL_STATUS and GLOBAL_VARIABLES are disabled by
+    default from MySQL 5.7 and gone in 8.0, whereas SHOW works everywhere.
+    """
+    return 'SHOW GLOBAL %s WHERE Variable_name IN (%s)' % (
+        kind, ', '.join("'%s'" % name for name in variables))
+
+
+def close_connection():
+    conn, CONNECTION['conn'] = CONNECTION['conn'], None
+    if conn is not None:
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+
+def driver_query(query, retry=True):
+    """Run query on the long-lived connection, opening it if need be.
+
+    Credentials are read from the defaults file only when connecting. If
+    the server has gone away since the last poll, the query is retried
+    once on a fresh connection.
+    """
+    if CONNECTION['conn'] is None:
+        kwargs = {'read_default_file': MYSQL_DEFAULTS_FILE}
+        if CONFIGS['ip']:
+            kwargs['host'] = CONFIGS['ip']
+        if CONFIGS['port']:
+            kwargs['port'] = int(CONFIGS['port'])
+        CONNECTION['conn'] = MySQLdb.connect(**kwargs)
+
+    try:
+        cursor = CONNECTION['conn'].cursor()
+        try:
+            cursor.execute(query)
+            return list(cursor.fetchall())
+        finally:
+            cursor.close()
+    except MySQLdb.OperationalError:
+        close_connection()
+        if not retry:
+            raise
+        return driver_query(query, retry=False)
+
+
+def query_mysql(query):
+    """Return the (name, value) rows of query.
+
+    The MySQLdb driver is used when it is installed, otherwise the mysql
+    client is run and its tab-separated output parsed.
+    """
+    if MySQLdb is not None:
+        try:
+            return driver_query(query)
+        except MySQLdb.Error as e:
+            status_err(str(e))
+
+    retcode, output, err = galera_check(
+        generate_query(CONFIGS['ip'], CONFIGS['port'], query)
+    )
+
+    if retcode > 0:
+        status_err(err)
+
+    if not output:
+        status_err('No output received from mysql. \
+                   Cannot gather metrics.')
+
+    return [line.split('\t', 1) for line in output.split('\n')[1:-1]]
+
+
+def fetch_variables(kind, variables):
+    """Return {name: value} for the named global STATUS or VARIABLES."""
+    return dict(query_mysql(generate_show(kind, variables)))
+
+
+def get_variables(uptime):
+    """Return the cached server variables, refetching them when stale."""
+    if (VARIABLES_CACHE['variables'] is None or
+            uptime < VARIABLES_CACHE['uptime'] or
+            time.time() - VARIABLES_CACHE['fetched'] >=
+            CONFIGS['variables_ttl']):
+        VARIABLES_CACHE['variables'] = fetch_variables('VARIABLES',
+                                                       VARIABLE_NAMES)
+        VARIABLES_CACHE['fetched'] = time.time()
+    VARIABLES_CACHE['uptime'] = uptime
+    return VARIABLES_CACHE['variables']
+
+
+def counter_rates(replica_status):
+    """Return {counter: per-second rate} since the previous poll.
+
+    A counter has no rate on its first poll, nor when it is lower than
+    before because the server restarted; its sample is kept either way.
+    """
+    now = monotonic()
+    rates = {}
+    for name in RATE_COUNTERS:
+        value = int(replica_status[name])
+        previous = RATE_SAMPLES.get(name)
+        RATE_SAMPLES[name] = (value, now)
+        if previous is None or value < previous[0] or now <= previous[1]:
+            continue
+        rates[name] = (value - previous[0]) / (now - previous[1])
+    return rates
 
 
 def parse_args():
@@ -103,7 +257,7 @@ def parse_args():
     return parser.parse_args()
 
 
-def print_metrics(replica_status):
+def print_metrics(replica_status, rates):
     status_ok()
     metric(PLUGIN, 'wsrep_replicated_bytes',
            replica_status['wsrep_replicated_bytes'],
@@ -121,10 +275,10 @@ def print_metrics(replica_status):
            replica_status['wsrep_cluster_size'],
            graphite_host=CONFIGS['graphite_host'],
            graphite_port=CONFIGS['graphite_port'])
-    metric(PLUGIN, 'queries_per_second',
-           replica_status['Queries'],
-           graphite_host=CONFIGS['graphite_host'],
-           graphite_port=CONFIGS['graphite_port'])
+    for name, rate in rates.items():
+        metric(PLUGIN, RATE_COUNTERS[name], '%.3f' % rate,
+               graphite_host=CONFIGS['graphite_host'],
+               graphite_port=CONFIGS['graphite_port'])
     # metric('wsrep_cluster_state_uuid', 'string',
     #        replica_status['wsrep_cluster_state_uuid'])
     # metric('wsrep_cluster_status', 'string',
@@ -149,23 +303,9 @@ def print_metrics(replica_status):
 
 def main():
     try:
-        replica_status = {}
-        for output_type in ['status', 'variables']:
-            retcode, output, err = galera_check(
-                generate_query(CONFIGS['ip'], CONFIGS['port'],
-                               output_type=output_type)
-            )
-
-            if retcode > 0:
-                status_err(err)
-
-            if not output:
-                status_err('No output received from mysql. \
-                           Cannot gather metrics.')
-
-            show_list = output.split('\n')[1:-1]
-            for i in show_list:
-                replica_status[i.split('\t')[0]] = i.split('\t')[1]
+        replica_status = fetch_variables('STATUS', STATUS_NAMES)
+        replica_status.update(get_variables(int(replica_status['Uptime'])))
+        rates = counter_rates(replica_status)
 
         if replica_status['wsrep_cluster_status'] != "Primary":
             status_err("there is a partition in the cluster")
@@ -176,7 +316,7 @@ def main():
 
         if (int(replica_status['wsrep_local_state']) == 4 and
                 replica_status['wsrep_local_state_comment'] == "Synced"):
-            print_metrics(replica_status)
+            print_metrics(replica_status, rates)
         metric_bool(PLUGIN, '{}_status'.format(PLUGIN), True,
                     graphite_host=CONFIGS['graphite_host'],
                     graphite_port=CONFIGS['graphite_port'])
@@ -185,8 +325,10 @@ def main():
                     graphite_host=CONFIGS['graphite_host'],
                     graphite_port=CONFIGS['graphite_port'])
         raise
+    finally:
+        flush_metrics()
 
 
 # register callbacks
 collectd.register_config(configure_callback)
-collectd.register_read(main)
+collectd.register_read(run_in_background(PLUGIN, main, CONFIGS))
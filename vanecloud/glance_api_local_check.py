@@ -17,26 +17,43 @@
 import collections
 import time
 
-from glanceclient import exc as exc
+from maas_common import APIRequest
+from maas_common import configure_graphite
+from maas_common import count_listing
+from maas_common import flush_metrics
+from maas_common import get_api_poller
+from maas_common import get_auth_details
 from maas_common import get_auth_ref
-from maas_common import get_glance_client
+from maas_common import get_endpoint_type
+from maas_common import get_endpoint_url_for_service
+from maas_common import get_keystone_client
 from maas_common import metric
 from maas_common import metric_bool
+from maas_common import next_page
+from maas_common import run_in_background
 from maas_common import status_err
 from maas_common import status_ok
+from maas_common import SPOOL_MAX_BYTES
+from requests import exceptions as exc
 import collectd
 
 CONFIGS = {}
 IMAGE_STATUSES = ['active', 'queued', 'killed']
 PLUGIN = 'glance_api_local_check'
+COUNT_MODES = ['detail', 'server']
 
 
 def configure_callback(conf):
     """Receive configuration block"""
     ip = None
     interval = 10
+    timeout = 10
     graphite_host = None
     graphite_port = None
+    graphite_protocol = 'plaintext'
+    graphite_spool_size = SPOOL_MAX_BYTES
+    count_mode = 'detail'
+    page_size = 1000
 
     for node in conf.children:
         key = node.key
@@ -46,50 +63,144 @@ def configure_callback(conf):
             ip = val
         elif key == 'interval':
             interval = val
+        elif key == 'timeout':
+            timeout = val
         elif key == 'graphite_host':
             graphite_host = val
         elif key == 'graphite_port':
             graphite_port = val
+        elif key == 'graphite_protocol':
+            graphite_protocol = val
+        elif key == 'graphite_spool_size':
+            graphite_spool_size = val
+        elif key == 'count_mode':
+            count_mode = val
+        elif key == 'page_size':
+            page_size = int(val)
         else:
             collectd.warning('glance_api_local_check: Unknown config key: {}'
                              .format(key))
             continue
 
+    if count_mode not in COUNT_MODES:
+        collectd.warning('glance_api_local_check: Unknown count_mode: {}, '
+                         'using detail'.format(count_mode))
+        count_mode = 'detail'
+
     auth_ref = get_auth_ref()
     CONFIGS['ip'] = ip
     CONFIGS['auth_ref'] = auth_ref
     CONFIGS['interval'] = interval
+    CONFIGS['timeout'] = timeout
     CONFIGS['graphite_host'] = graphite_host
     CONFIGS['graphite_port'] = graphite_port
+    CONFIGS['count_mode'] = count_mode
+    CONFIGS['page_size'] = page_size
+    configure_graphite(graphite_host, graphite_port, graphite_protocol,
+                       graphite_spool_size)
+
+
+def count_by_status(endpoint):
+    """Count images per status from filtered summary listings.
+
+    The v1 summary listing (/images rather than /images/detail) carries no
+    properties, and filtering on status server-side means only the matching
+    images are sent at all. Glance v1 has no way of counting server-side,
+    unlike cinder's with_count, so every matching image summary is still
+    paged through, one request per page_size images, whereas cinder's
+    server mode costs one request per status. The gain over detail mode is
+    only in the much smaller pages; asking for limit=1 pages wouldn't help,
+    it would just take one request per image.
+    Returns (milliseconds, status_count), with a None count for any status
+    whose listing failed.
+    """
+    auth_token = get_keystone_client(CONFIGS['auth_ref']).auth_token
+    reducer = count_listing('images', CONFIGS['page_size'])
+    # is_public=None lists every tenant's images, like all_tenants did
+    api_requests = [APIRequest(status, '%s/images' % endpoint,
+                               {'status': status, 'is_public': 'None',
+                                'limit': CONFIGS['page_size']},
+                               reducer)
+                    for status in IMAGE_STATUSES]
+
+    start = time.time()
+    status_count = get_api_poller().poll(auth_token, api_requests,
+                                         timeout=10)
+    end = time.time()
+    return (end - start) * 1000, status_count
+
+
+def summarise(response):
+    """Count the statuses of a paged /images/detail listing.
+
+    Follows limit/marker pagination from the first response until a page
+    comes back empty, decoding each page exactly once and keeping only the
+    counters, so memory is bounded by page_size rather than by the number
+    of images.
+    """
+    summary = {'ok': response.ok,
+               'milliseconds': response.elapsed.total_seconds() * 1000,
+               'statuses': collections.Counter()}
+    params = {'is_public': 'None', 'limit': CONFIGS['page_size']}
+    while response.ok:
+        body = response.json()
+        summary['statuses'].update(image['status']
+                                   for image in body['images'])
+        params = next_page(body, 'images', params)
+        if params is None:
+            break
+        response = get_api_poller().follow(response, params)
+        summary['ok'] = response.ok
+    return summary
+
+
+def count_by_detail(endpoint):
+    """Count images per status from one detailed listing of every image.
+
+    The listing is both the timed request and the data: the response time
+    is that of its first page and the total time that of the whole listing.
+    Returns (milliseconds, total_milliseconds, status_count), with a None
+    status_count if any page failed.
+    """
+    auth_token = get_keystone_client(CONFIGS['auth_ref']).auth_token
+    start = time.time()
+    summary = get_api_poller().poll(auth_token, [
+        APIRequest('images', '%s/images/detail' % endpoint,
+                   {'is_public': 'None', 'limit': CONFIGS['page_size']},
+                   summarise)
+    ], timeout=10)['images']
+    end = time.time()
+    if not summary['ok']:
+        return summary['milliseconds'], (end - start) * 1000, None
+    return (summary['milliseconds'], (end - start) * 1000,
+            summary['statuses'])
 
 
 def check():
     try:
-        GLANCE_ENDPOINT = (
-            'http://{ip}:9292/v1'.format(ip=CONFIGS['ip'])
-        )
+        if CONFIGS['ip']:
+            GLANCE_ENDPOINT = 'http://{ip}:9292/v1'.format(ip=CONFIGS['ip'])
+        else:
+            GLANCE_ENDPOINT = get_endpoint_url_for_service(
+                'image', get_auth_ref(),
+                get_endpoint_type(get_auth_details())).rstrip('/')
+            if not GLANCE_ENDPOINT.endswith('/v1'):
+                GLANCE_ENDPOINT += '/v1'
 
         try:
-            if CONFIGS['ip']:
-                glance = get_glance_client(endpoint=GLANCE_ENDPOINT)
+            if CONFIGS['count_mode'] == 'server':
+                milliseconds, status_count = count_by_status(GLANCE_ENDPOINT)
+                total_milliseconds = milliseconds
+                is_up = None not in status_count.values()
             else:
-                glance = get_glance_client()
-
-            is_up = True
-        except exc.HTTPException:
+                milliseconds, total_milliseconds, status_count = \
+                    count_by_detail(GLANCE_ENDPOINT)
+                is_up = status_count is not None
+        except (exc.ConnectionError, exc.HTTPError, exc.Timeout):
             is_up = False
         # Any other exception presumably isn't an API error
         except Exception as e:
             status_err(str(e))
-        else:
-            # time something arbitrary
-            start = time.time()
-            glance.images.list(search_opts={'all_tenants': 1})
-            end = time.time()
-            milliseconds = (end - start) * 1000
-            # gather some metrics
-            images = glance.images.list(search_opts={'all_tenants': 1})
-            status_count = collections.Counter([s.status for s in images])
 
         status_ok()
         metric_bool(PLUGIN, 'glance_api_local_status', is_up,
@@ -103,6 +214,11 @@ def check():
                    '%.3f' % milliseconds,
                    graphite_host=CONFIGS['graphite_host'],
                    graphite_port=CONFIGS['graphite_port'])
+            metric(PLUGIN,
+                   'glance_api_local_total_time',
+                   '%.3f' % total_milliseconds,
+                   graphite_host=CONFIGS['graphite_host'],
+                   graphite_port=CONFIGS['graphite_port'])
             for status in IMAGE_STATUSES:
                 metric(PLUGIN,
                        'glance_%s_images' % status,
@@ -114,8 +230,10 @@ def check():
                     graphite_host=CONFIGS['graphite_host'],
                     graphite_port=CONFIGS['graphite_port'])
         raise
+    finally:
+        flush_metrics()
 
 
 # register callbacks
 collectd.register_config(configure_callback)
-collectd.register_read(check)
+collectd.register_read(run_in_background(PLUGIN, check, CONFIGS))
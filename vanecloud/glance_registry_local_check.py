@@ -14,13 +14,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from maas_common import APIRequest
+from maas_common import configure_graphite
+from maas_common import flush_metrics
+from maas_common import get_api_poller
 from maas_common import get_auth_ref
 from maas_common import get_keystone_client
 from maas_common import metric
 from maas_common import metric_bool
+from maas_common import run_in_background
 from maas_common import status_err
 from maas_common import status_ok
-import requests
+from maas_common import SPOOL_MAX_BYTES
 from requests import exceptions as exc
 import collectd
 
@@ -32,8 +37,11 @@ def configure_callback(conf):
     """Receive configuration block"""
     ip = None
     interval = 10
+    timeout = 10
     graphite_host = None
     graphite_port = None
+    graphite_protocol = 'plaintext'
+    graphite_spool_size = SPOOL_MAX_BYTES
 
     for node in conf.children:
         key = node.key
@@ -43,10 +51,16 @@ def configure_callback(conf):
             ip = val
         elif key == 'interval':
             interval = val
+        elif key == 'timeout':
+            timeout = val
         elif key == 'graphite_host':
             graphite_host = val
         elif key == 'graphite_port':
             graphite_port = val
+        elif key == 'graphite_protocol':
+            graphite_protocol = val
+        elif key == 'graphite_spool_size':
+            graphite_spool_size = val
         else:
             collectd.warning('glance_registry_local_check: Unknown config key:\
                              {}'.format(key))
@@ -56,8 +70,11 @@ def configure_callback(conf):
     CONFIGS['ip'] = ip
     CONFIGS['auth_ref'] = auth_ref
     CONFIGS['interval'] = interval
+    CONFIGS['timeout'] = timeout
     CONFIGS['graphite_host'] = graphite_host
     CONFIGS['graphite_port'] = graphite_port
+    configure_graphite(graphite_host, graphite_port, graphite_protocol,
+                       graphite_spool_size)
 
 
 def check():
@@ -68,16 +85,12 @@ def check():
         auth_token = keystone.auth_token
         registry_endpoint = 'http://{ip}:9191'.format(ip=CONFIGS['ip'])
 
-        s = requests.Session()
-
-        s.headers.update(
-            {'Content-type': 'application/json',
-             'x-auth-token': auth_token})
-
         try:
             # /images returns a list of public, non-deleted images
-            r = s.get('%s/images' % registry_endpoint, verify=False,
-                      timeout=10)
+            r = get_api_poller().poll(auth_token, [
+                APIRequest('images', '%s/images' % registry_endpoint, None,
+                           None)
+            ], timeout=10)['images']
             is_up = r.ok
         except (exc.ConnectionError, exc.HTTPError, exc.Timeout):
             is_up = False
@@ -100,8 +113,10 @@ def check():
                     graphite_host=CONFIGS['graphite_host'],
                     graphite_port=CONFIGS['graphite_port'])
         raise
+    finally:
+        flush_metrics()
 
 
 # register callbacks
 collectd.register_config(configure_callback)
-collectd.register_read(check)
+collectd.register_read(run_in_background(PLUGIN, check, CONFIGS))
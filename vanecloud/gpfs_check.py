@@ -1,15 +1,30 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
+import collections
+from multiprocessing.pool import ThreadPool
+import os
 import re
+import select
+import shlex
 import subprocess
 import string
+import threading
+import time
+from maas_common import CHECK_EXECUTOR
+from maas_common import configure_graphite
+from maas_common import flush_metrics
 from maas_common import metric
+from maas_common import run_in_background
+from maas_common import SPOOL_MAX_BYTES
 
 __version__ = '0.1'
 __author__ = 'Guan Ji Chen @ vaneCloud.com'
 
 PLUGIN = 'gpfs_check'
+# name the slow admin commands run under on the check executor in mmpmon
+# mode, so they never hold up the mmpmon samples
+SLOW_PLUGIN = 'gpfs_check_slow'
 
 global VERBOSE_LOGGING
 VERBOSE_LOGGING = True
@@ -18,6 +33,125 @@ COLLECTD_GPFS = {}
 MMFSPATH = '/usr/lpp/mmfs/bin'
 GRAPHITE_HOST = None
 GRAPHITE_PORT = None
+GRAPHITE_PROTOCOL = 'plaintext'
+GRAPHITE_SPOOL_SIZE = SPOOL_MAX_BYTES
+GPFS_WORKERS = 4
+COMMAND_TIMEOUT = 30
+FILESYSTEM_TTL = 300
+# 'commands' forks the admin commands every interval, 'mmpmon' reads I/O
+# counters from one mmpmon process and runs the commands every SLOW_INTERVAL
+GPFS_MODE = 'commands'
+GPFS_MODES = ['commands', 'mmpmon']
+SLOW_INTERVAL = 600
+KEYFRAME_INTERVAL = 300
+# mmpmon counters and the names their rates are sent as
+MMPMON_COUNTERS = [('_br_', 'read_bytes'), ('_bw_', 'write_bytes'),
+                   ('_oc_', 'opens'), ('_cc_', 'closes'),
+                   ('_rdc_', 'reads'), ('_wc_', 'writes')]
+
+
+# record types of -Y output, by header row
+Y_RECORDS = {}
+
+
+def parse_y(output):
+    """Yield (section, record) for each data row of a GPFS -Y listing.
+
+    -Y output is colon-delimited and each section, named by its second
+    column (e.g. mmdf's 'fsTotal'), starts with a HEADER row naming the
+    columns. Rows are split once into namedtuples built from that header,
+    so columns are read by name, e.g. record.nodeName.
+    """
+    headers = {}
+    for line in (output or '').splitlines():
+        fields = line.split(':')
+        if len(fields) < 3:
+            continue
+        if fields[2] == 'HEADER':
+            header = tuple(fields)
+            if header not in Y_RECORDS:
+                Y_RECORDS[header] = collections.namedtuple('YRecord', header,
+                                                           rename=True)
+            headers[fields[1]] = Y_RECORDS[header]
+            continue
+        record = headers.get(fields[1])
+        if record is None:
+            continue
+        width = len(record._fields)
+        if len(fields) != width:
+            fields = fields[:width] + [''] * (width - len(fields))
+        yield fields[1], record._make(fields)
+
+
+class MMPMon(object):
+
+    """A long-lived mmpmon coprocess answering fs_io_s and io_s."""
+
+    def __init__(self, path):
+        self.path = path
+        self.child = None
+        self.buffer = ''
+
+    def _start(self):
+        with open(os.devnull, 'w') as devnull:
+            self.child = subprocess.Popen([self.path, '-p', '-s'],
+                                          stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          stderr=devnull)
+        self.buffer = ''
+
+    def close(self):
+        child, self.child = self.child, None
+        if child is not None:
+            try:
+                child.kill()
+            except OSError:
+                pass
+            child.wait()
+
+    def _readline(self, deadline):
+        fd = self.child.stdout.fileno()
+        while '\n' not in self.buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [],
+                                                   remaining)[0]:
+                raise IOError('mmpmon timed out')
+            data = os.read(fd, 65536)
+            if not data:
+                raise IOError('mmpmon exited')
+            self.buffer += data
+        line, self.buffer = self.buffer.split('\n', 1)
+        return line
+
+    def sample(self, timeout):
+        """
+        :returns: ({filesystem: fs_io_s record}, io_s record)
+
+        Records map mmpmon's -p keys, e.g. '_br_', to their values. The
+        io_s reply is a single line, so it also marks the end of the
+        fs_io_s lines before it. The coprocess is restarted on the next
+        sample if it died or did not answer in time.
+        """
+        if self.child is None:
+            self._start()
+        try:
+            self.child.stdin.write('fs_io_s\nio_s\n')
+            self.child.stdin.flush()
+            deadline = time.time() + timeout
+            filesystems = {}
+            while True:
+                tokens = self._readline(deadline).split()
+                if not tokens:
+                    continue
+                record = dict(zip(tokens[1::2], tokens[2::2]))
+                if tokens[0] == '_io_s_':
+                    return filesystems, record
+                if (tokens[0] == '_fs_io_s_' and '_fs_' in record and
+                        record.get('_rc_') == '0'):
+                    filesystems[record['_fs_']] = record
+        except (IOError, OSError):
+            self.close()
+            raise
 
 
 class GPFS(object):
@@ -28,20 +162,32 @@ class GPFS(object):
         """TODO: to be defined. """
         self.metrics = {}
         self.colleced = False
+        self.filesystems = None
+        self.filesystems_fetched = 0
+        self.pool = None
+        self.mmpmon = None
+        self.io_samples = {}
+        self.slow_collected = 0
+        # the last node states and error_node_num seen by the slow checks
+        self.nodes = {}
+        # runs the slow checks into its own metrics in mmpmon mode
+        self.slow = None
+        self.node_states = {}
+        self.keyframe_sent = 0
 
     def _get_gpfs_cluster_status(self):
         """
         :returns: {cl.cluster.status: 0|1}
 
         """
-        fd = self._run(cmd='/usr/lpp/mmfs/bin/mmfsadm dump tscomm')
-        fdd = self._get_childs_data(fd)
+        fdd = self._output(cmd='/usr/lpp/mmfs/bin/mmfsadm dump tscomm')
         if fdd:
             cluster_status = 1
         else:
             cluster_status = 0
-        fd = self._run(cmd='/usr/lpp/mmfs/bin/mmlscluster')
-        fdd = self._get_childs_data(fd)
+        fdd = self._output(cmd='/usr/lpp/mmfs/bin/mmlscluster')
+        if not fdd:
+            return
         for line in fdd.splitlines():
             searchObj = re.search(r'GPFS\ cluster\ name:(.*)$', line)
             if searchObj:
@@ -57,49 +203,56 @@ class GPFS(object):
                     {no.node3.status: 0|1}
                     ]
         """
-        fd = self._run(cmd='/usr/lpp/mmfs/bin/mmgetstate -aLY')
-        fdd = self._get_childs_data(fd)
+        fdd = self._output(cmd='/usr/lpp/mmfs/bin/mmgetstate -aLY')
+        nodes = {}
         error_node_num = 0
+        for _, node in parse_y(fdd):
+            # Explain node state
+            if node.state == 'down':
+                node_status = 0
+                error_node_num += 1
+            elif node.state == 'active':
+                node_status = 1
+            elif node.state == 'arbitraiting':
+                node_status = 2
+                error_node_num += 1
+            else:
+                node_status = 3
+                error_node_num += 1
+            nodes['node.' + node.nodeName + '_status'] = node_status
+        nodes['error_node_num'] = error_node_num
+        self.metrics.update(nodes)
+        self.nodes = nodes
+        return
+
+    def _get_filesystems(self):
+        """
+        :returns: [filesystem1, filesystem2, ...]
+
+        mmlsfs is cluster-wide and slow, so the list is fetched at most
+        once every FILESYSTEM_TTL seconds and shared by the per-filesystem
+        checks.
+        """
+        if (self.filesystems is not None and
+                time.time() - self.filesystems_fetched < FILESYSTEM_TTL):
+            return self.filesystems
+        fdd = self._output(cmd='/usr/lpp/mmfs/bin/mmlsfs all -Y')
         if fdd:
-            for line in fdd.splitlines()[1:]:
-                """
-                0:  mmgetstate
-                1:  not used
-                2:  HEADER
-                3:  version
-                4:  reserved
-                5:  reserved
-                6:  nodeName
-                7:  nodeNumber
-                8:  state
-                9:  quorum
-                10: nodesUp
-                11: totalNodes
-                12: remarks
-                13: cnfsState
-                14: NULL
-                """
-                node_name = line.split(':')[6]
-                # Explain node state
-                if line.split(':')[8] == 'down':
-                    node_status = 0
-                    error_node_num += 1
-                elif line.split(':')[8] == 'active':
-                    node_status = 1
-                elif line.split(':')[8] == 'arbitraiting':
-                    node_status = 2
-                    error_node_num += 1
-                else:
-                    node_status = 3
-                    error_node_num += 1
-                self.metrics['node.' + node_name + '_status'] = node_status
+            # every filesystem has exactly one inodeSize attribute
+            fs = [attr.deviceName for _, attr in parse_y(fdd)
+                  if attr.fieldName == 'inodeSize']
         else:
-            pass
-        self.metrics['error_node_num'] = error_node_num
-        return
+            if self.colleced:
+                collectd.info("Get filesystem information failed")
+            else:
+                print "Get Filesystem information failed"
+            return self.filesystems or []
+        self.filesystems = fs
+        self.filesystems_fetched = time.time()
+        return fs
 
-    def _get_gpfs_disk_status(self):
-        """TODO
+    def _get_gpfs_disk_status(self, fsi):
+        """
         :returns: [
                     {di.disk1.status: 0|1|2},
                     {di.disk1.status: 0|1|2},
@@ -107,80 +260,23 @@ class GPFS(object):
                     ]
 
         """
-        """
-        GET Filesystem FIRST, THEN GET DISK STATUS
-        """
-        fd = self._run(cmd='/usr/lpp/mmfs/bin/mmlsfs all -Y')
-        fdd = self._get_childs_data(fd)
-        fs = []
-        if fdd:
-            for line in fdd.splitlines()[1:]:
-                """
-                0: mmlsfs
-                1: not used
-                2: HEADER
-                3: version
-                4: reserved
-                5: reserved
-                6: deviceName
-                7: filedName
-                8: data
-                9: remarks
-                10: not used
-                """
-                # Explain filesystem state
-                if line.split(':')[7] == 'inodeSize':
-                    fs.append(line.split(':')[6])
-        else:
-            if self.colleced:
-                collectd.info("et disk information failed")
+        fdd = self._output(cmd='/usr/lpp/mmfs/bin/mmlsdisk ' + fsi + ' -Y')
+        for _, disk in parse_y(fdd):
+            # Explain disk state
+            status = disk.status
+            if status == 'down':
+                disk_status = 0
+            elif status == 'ready':
+                disk_status = 1
+            elif status == 'suspended':
+                disk_status = 2
             else:
-                print "Get disk information failed"
-        for fsi in fs:
-            fd = self._run(cmd='/usr/lpp/mmfs/bin/mmlsdisk ' + fsi + ' -Y')
-            fdd = self._get_childs_data(fd)
-            disk_status = 0
-            for line in fdd.splitlines()[1:]:
-                """
-                0: mmlsdisk
-                1: not used
-                2: HEADER
-                3: version
-                4: reserved
-                5: reserved
-                6: nsdName
-                7: driverType
-                8: sectorSize
-                9: failureGroup
-                10: metadata
-                11: data
-                12: status
-                13: availability
-                14: diskID
-                15: storagePool
-                16: remarks
-                17: numQuorumDisks
-                18: readQuorumValue
-                19: writeQuorumValue
-                20: diskSizeKB
-                21: diskUID
-                22: not used
-                """
-                disk_name = line.split(':')[6]
-                # Explain disk state
-                if line.split(':')[12] == 'down':
-                    disk_status = 0
-                elif line.split(':')[12] == 'ready':
-                    disk_status = 1
-                elif line.split(':')[12] == 'suspended':
-                    disk_status = 2
-                else:
-                    disk_status = 3
-            	self.metrics['disk.' + disk_name + '_status'] = disk_status
+                disk_status = 3
+            self.metrics['disk.' + disk.nsdName + '_status'] = disk_status
         return
 
-    def _get_gpfs_filesystem_status(self):
-        """TODO
+    def _get_gpfs_filesystem_status(self, fsd):
+        """
         :returns: [
                     {fi.filesystem1.status: 0|1},
                     {fi.filesystem2.status: 0|1},
@@ -188,65 +284,17 @@ class GPFS(object):
         ]
 
         """
-        fd = self._run(cmd='/usr/lpp/mmfs/bin/mmlsfs all -Y')
-        fdd = self._get_childs_data(fd)
-        fs = []
-        if fdd:
-            for line in fdd.splitlines()[1:]:
-                """
-                0: mmlsfs
-                1: not used
-                2: HEADER
-                3: version
-                4: reserved
-                5: reserved
-                6: deviceName
-                7: filedName
-                8: data
-                9: remarks
-                10: not used
-                """
-                # Explain filesystem state
-                if line.split(':')[7] == 'inodeSize':
-                    fs.append(line.split(':')[6])
-        else:
-            if self.colleced:
-                collectd.info("et disk information failed")
+        fdd = self._output(cmd='/usr/lpp/mmfs/bin/mmlsmount ' + fsd + ' -Y')
+        for _, mount in parse_y(fdd):
+            if mount.totalNodes == '0':
+                filesystem_status = 0
             else:
-                print "Get Filesystem information failed"
-        for fsd in fs:
-            fd = self._run(cmd='/usr/lpp/mmfs/bin/mmlsmount ' + fsd + ' -Y')
-            fdd = self._get_childs_data(fd)
-            for line in fdd.splitlines()[1:]:
-                """
-                0: mmlsmount
-                1: not used
-                2: HEADER
-                3: version
-                4: reserved
-                5: reserved
-                6: localDevName
-                7: readDevName
-                8: owningCluster
-                9: totalNodes
-                10: nodeIP
-                11: nodeName
-                12: clusterName
-                13: mountMode
-                """
-                if line.split(':')[9] == '0':
-                    filesystem_status = 0
-                else:
-                    filesystem_status = 1
+                filesystem_status = 1
             self.metrics['filesystem.' + fsd + '_status'] = filesystem_status
         return
 
-    def _get_filesystems(self):
-        """ TODO: merge get filesystem names functions from other functions"""
-        pass
-
-    def _get_gpfs_filesystem_usage(self):
-        """TODO
+    def _get_gpfs_filesystem_usage(self, fsd):
+        """
         :returns: [
                     {fi.filesystem1.usage: 0-100},
                     {fi.filesystem2.usage: 0-100},
@@ -254,71 +302,52 @@ class GPFS(object):
                     ]
 
         """
-        fd = self._run(cmd='/usr/lpp/mmfs/bin/mmlsfs all -Y')
-        fdd = self._get_childs_data(fd)
-        fs = []
-        if fdd:
-            for line in fdd.splitlines()[1:]:
-                """
-                0: mmlsfs
-                1: not used
-                2: HEADER
-                3: version
-                4: reserved
-                5: reserved
-                6: deviceName
-                7: filedName
-                8: data
-                9: remarks
-                10: not used
-                """
-                # Explain filesystem state
-                if line.split(':')[7] == 'inodeSize':
-                    fs.append(line.split(':')[6])
-        else:
-            if self.colleced:
-                collectd.info("et disk information failed")
-            else:
-                print "Get Filesystem information failed"
-        for fsd in fs:
-            fd = self._run(cmd='/usr/lpp/mmfs/bin/mmdf ' + fsd + ' -Y')
-            fdd = self._get_childs_data(fd)
-            for line in fdd.splitlines()[4:]:
-                """
-                0: mmdf
-                1: fsTotal
-                2: HEADER
-                3: version
-                4: reserved
-                5: reserved
-                6: fsSize
-                7: freeBlocks
-                8: freeBlocksPct
-                9: freeFragments
-                10: freeFragementsPct
-                11: not used
-                """
-                if line.split(':')[1] == 'fsTotal':
-                    filesystem_usage = 100 - string.atoi(line.split(':')[8])
-            self.metrics['filesystem.' + fsd + '_usage'] = filesystem_usage
+        fdd = self._output(cmd='/usr/lpp/mmfs/bin/mmdf ' + fsd + ' -Y')
+        for section, total in parse_y(fdd):
+            if section == 'fsTotal':
+                filesystem_usage = 100 - string.atoi(total.freeBlocksPct)
+                self.metrics['filesystem.' + fsd + '_usage'] = \
+                    filesystem_usage
         return
 
     def dump_ds(self):
         """dump gpfs data
         :returns: TODO
 
+        The per-filesystem commands are independent and each take seconds,
+        so they run at the same time on up to GPFS_WORKERS threads.
         """
-        self._get_gpfs_cluster_status()
-        self._get_gpfs_node_status()
-        self._get_gpfs_disk_status()
-        self._get_gpfs_filesystem_status()
-        self._get_gpfs_filesystem_usage()
+        if self.pool is None:
+            self.pool = ThreadPool(GPFS_WORKERS)
+        checks = [(self._get_gpfs_cluster_status, ()),
+                  (self._get_gpfs_node_status, ())]
+        for fs in self._get_filesystems():
+            checks.extend([(self._get_gpfs_disk_status, (fs,)),
+                           (self._get_gpfs_filesystem_status, (fs,)),
+                           (self._get_gpfs_filesystem_usage, (fs,))])
+        self.pool.map(lambda check: check[0](*check[1]), checks)
         if not self.colleced:
             print "data logged from console"
         else:
             self.log_verbose('data logged from plugin')
         return
 
+    def _output(self, cmd):
+        """Run cmd and return its output, or 0 if it failed.
+
+        Commands still running after COMMAND_TIMEOUT seconds are killed.
+        """
+        try:
+            child = self._run(cmd)
+        except OSError:
+            return 0
+        timer = threading.Timer(COMMAND_TIMEOUT, child.kill)
+        timer.start()
+        try:
+            return self._get_childs_data(child)
+        finally:
+            timer.cancel()
+
     def _get_childs_data(self, child):
         (stdout, stderr) = child.communicate()
         exp = child.poll()
@@ -343,17 +372,113 @@ class GPFS(object):
         """
         #  collectd.info('%s', cmd)
         #  print ('%s' % cmd)
-        return subprocess.Popen(cmd, bufsize=1, shell=True,
+        return subprocess.Popen(shlex.split(cmd), bufsize=1,
                                 stdout=subprocess.PIPE)
 
+    def _io_rates(self, key, record):
+        """
+        :returns: {counter: per-second rate} since key's previous record
+
+        There are no rates for a first record, or when counters went
+        backwards because mmpmon was reset or GPFS restarted.
+        """
+        now = int(record['_t_']) + int(record['_tu_']) / 1000000.0
+        previous = self.io_samples.get(key)
+        self.io_samples[key] = (record, now)
+        if previous is None or now <= previous[1]:
+            return {}
+        rates = {}
+        for field, name in MMPMON_COUNTERS:
+            delta = int(record[field]) - int(previous[0][field])
+            if delta < 0:
+                return {}
+            rates[name] = delta / (now - previous[1])
+        return rates
+
+    def _get_gpfs_io_rates(self):
+        """
+        :returns: [
+                    {filesystem.filesystem1_read_bytes_per_second: n},
+                    ...
+                    {io_read_bytes_per_second: n},
+                    ...
+                    ]
+
+        """
+        if self.mmpmon is None:
+            self.mmpmon = MMPMon(MMFSPATH + '/mmpmon')
+        try:
+            filesystems, io = self.mmpmon.sample(COMMAND_TIMEOUT)
+        except (IOError, OSError) as e:
+            collectd.warning('gpfs plugin: mmpmon failed: %s' % e)
+            return
+        for fs, record in filesystems.items():
+            for name, rate in self._io_rates('fs.' + fs, record).items():
+                self.metrics['filesystem.' + fs + '_' + name +
+                             '_per_second'] = '%.3f' % rate
+        for name, rate in self._io_rates('io', io).items():
+            self.metrics['io_' + name + '_per_second'] = '%.3f' % rate
+        return
+
     def read_callback(self):
-        self.dump_ds()
-        for key in self.metrics:
-            metric(PLUGIN,
-                   key,
-                   self.metrics[key],
-                   graphite_host=GRAPHITE_HOST,
-                   graphite_port=GRAPHITE_PORT)
+        if GPFS_MODE == 'mmpmon':
+            # only this cycle's rates; the slow checks report themselves
+            self.metrics = {}
+            self._get_gpfs_io_rates()
+            if time.time() - self.slow_collected >= SLOW_INTERVAL:
+                self.slow_collected = time.time()
+                CHECK_EXECUTOR.submit(SLOW_PLUGIN, self.slow_callback,
+                                      SLOW_INTERVAL)
+        else:
+            self.dump_ds()
+        # the slow checks may not have run this cycle, so the last node
+        # snapshot is reported whatever the mode: error_node_num every
+        # cycle, and node states, which rarely change, when they do and all
+        # of them every KEYFRAME_INTERVAL to keep graphs continuous
+        metrics = dict(self.metrics)
+        metrics.update(self.nodes)
+        keyframe = time.time() - self.keyframe_sent >= KEYFRAME_INTERVAL
+        if keyframe:
+            self.keyframe_sent = time.time()
+        try:
+            for key in metrics:
+                if key.startswith('node.'):
+                    if (not keyframe and
+                            self.node_states.get(key) == metrics[key]):
+                        continue
+                    self.node_states[key] = metrics[key]
+                metric(PLUGIN,
+                       key,
+                       metrics[key],
+                       graphite_host=GRAPHITE_HOST,
+                       graphite_port=GRAPHITE_PORT)
+        finally:
+            flush_metrics()
+
+    def slow_callback(self):
+        """Run the admin commands as a check of their own, for mmpmon mode.
+
+        They take up to COMMAND_TIMEOUT each, far longer than an mmpmon
+        sample, so they run on the check executor apart from read_callback
+        and into a GPFS of their own. Node states and error_node_num are
+        handed over to read_callback, which reports them every cycle.
+        """
+        if self.slow is None:
+            self.slow = GPFS()
+        try:
+            self.slow.metrics = {}
+            self.slow.dump_ds()
+            self.nodes = self.slow.nodes
+            for key, value in self.slow.metrics.items():
+                if key in self.nodes:
+                    continue
+                metric(PLUGIN,
+                       key,
+                       value,
+                       graphite_host=GRAPHITE_HOST,
+                       graphite_port=GRAPHITE_PORT)
+        finally:
+            flush_metrics()
 
     def log_verbose(self, msg):
         if not VERBOSE_LOGGING:
@@ -383,6 +508,14 @@ class GPFS(object):
         global VERBOSE_LOGGING
         global GRAPHITE_HOST
         global GRAPHITE_PORT
+        global GRAPHITE_PROTOCOL
+        global GRAPHITE_SPOOL_SIZE
+        global GPFS_WORKERS
+        global COMMAND_TIMEOUT
+        global FILESYSTEM_TTL
+        global GPFS_MODE
+        global SLOW_INTERVAL
+        global KEYFRAME_INTERVAL
         for node in conf.children:
             val = str(node.values[0])
             if node.key == 'Verbose':
@@ -394,6 +527,29 @@ class GPFS(object):
                 GRAPHITE_HOST = node.values[0]
             elif node.key == 'graphite_port':
                 GRAPHITE_PORT = node.values[0]
+            elif node.key == 'graphite_protocol':
+                GRAPHITE_PROTOCOL = node.values[0]
+            elif node.key == 'graphite_spool_size':
+                GRAPHITE_SPOOL_SIZE = node.values[0]
+            elif node.key == 'timeout':
+                COLLECTD_GPFS['timeout'] = node.values[0]
+            elif node.key == 'workers':
+                GPFS_WORKERS = int(node.values[0])
+            elif node.key == 'command_timeout':
+                COMMAND_TIMEOUT = float(node.values[0])
+            elif node.key == 'filesystem_ttl':
+                FILESYSTEM_TTL = float(node.values[0])
+            elif node.key == 'mode':
+                if val in GPFS_MODES:
+                    GPFS_MODE = val
+                else:
+                    collectd.warning('gpfs plugin: Unknown mode: %s' % val)
+            elif node.key == 'slow_interval':
+                SLOW_INTERVAL = float(node.values[0])
+            elif node.key == 'keyframe_interval':
+                KEYFRAME_INTERVAL = float(node.values[0])
+        configure_graphite(GRAPHITE_HOST, GRAPHITE_PORT, GRAPHITE_PROTOCOL,
+                           GRAPHITE_SPOOL_SIZE)
 
 
 def fetch_info(conf):
@@ -427,4 +583,5 @@ else:
     # Register callbacks
     gpfs = GPFS()
     collectd.register_config(gpfs.configure_callback)
-    collectd.register_read(gpfs.read_callback)
+    collectd.register_read(run_in_background(PLUGIN, gpfs.read_callback,
+                                             COLLECTD_GPFS))
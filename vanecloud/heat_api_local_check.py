@@ -14,16 +14,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import time
-
-from heatclient import exc
+from maas_common import APIRequest
+from maas_common import configure_graphite
+from maas_common import flush_metrics
+from maas_common import get_api_poller
+from maas_common import get_auth_details
 from maas_common import get_auth_ref
-from maas_common import get_heat_client
+from maas_common import get_endpoint_type
+from maas_common import get_endpoint_url_for_service
 from maas_common import get_keystone_client
 from maas_common import metric
 from maas_common import metric_bool
+from maas_common import run_in_background
 from maas_common import status_err
 from maas_common import status_ok
+from maas_common import SPOOL_MAX_BYTES
+from requests import exceptions as exc
 import collectd
 
 CONFIGS = {}
@@ -34,8 +40,11 @@ def configure_callback(conf):
     """Receive configuration block"""
     ip = None
     interval = 10
+    timeout = 10
     graphite_host = None
     graphite_port = None
+    graphite_protocol = 'plaintext'
+    graphite_spool_size = SPOOL_MAX_BYTES
 
     for node in conf.children:
         key = node.key
@@ -45,10 +54,16 @@ def configure_callback(conf):
             ip = val
         elif key == 'interval':
             interval = val
+        elif key == 'timeout':
+            timeout = val
         elif key == 'graphite_host':
             graphite_host = val
         elif key == 'graphite_port':
             graphite_port = val
+        elif key == 'graphite_protocol':
+            graphite_protocol = val
+        elif key == 'graphite_spool_size':
+            graphite_spool_size = val
         else:
             collectd.warning('heat_api_local_check: Unknown config key: {}'
                              .format(key))
@@ -58,36 +73,40 @@ def configure_callback(conf):
     CONFIGS['ip'] = ip
     CONFIGS['auth_ref'] = auth_ref
     CONFIGS['interval'] = interval
+    CONFIGS['timeout'] = timeout
     CONFIGS['graphite_host'] = graphite_host
     CONFIGS['graphite_port'] = graphite_port
+    configure_graphite(graphite_host, graphite_port, graphite_protocol,
+                       graphite_spool_size)
 
 
 def check():
     try:
         keystone = get_keystone_client(CONFIGS['auth_ref'])
-        tenant_id = keystone.tenant_id
+        auth_token = keystone.auth_token
 
-        HEAT_ENDPOINT = ('http://{ip}:8004/v1/{tenant}'.format
-                         (ip=CONFIGS['ip'], tenant=tenant_id))
+        if CONFIGS['ip']:
+            HEAT_ENDPOINT = ('http://{ip}:8004/v1/{tenant}'.format
+                             (ip=CONFIGS['ip'], tenant=keystone.tenant_id))
+        else:
+            HEAT_ENDPOINT = get_endpoint_url_for_service(
+                'orchestration', get_auth_ref(),
+                get_endpoint_type(get_auth_details())).rstrip('/')
 
         try:
-            if CONFIGS['ip']:
-                heat = get_heat_client(endpoint=HEAT_ENDPOINT)
-            else:
-                heat = get_heat_client()
-
-            is_up = True
-        except exc.HTTPException as e:
+            # time something arbitrary
+            r = get_api_poller().poll(auth_token, [
+                APIRequest('build_info', '%s/build_info' % HEAT_ENDPOINT,
+                           None, None)
+            ], timeout=10)['build_info']
+            is_up = r.ok
+        except (exc.ConnectionError, exc.HTTPError, exc.Timeout):
             is_up = False
         # Any other exception presumably isn't an API error
         except Exception as e:
             status_err(str(e))
         else:
-            # time something arbitrary
-            start = time.time()
-            heat.build_info.build_info()
-            end = time.time()
-            milliseconds = (end - start) * 1000
+            milliseconds = r.elapsed.total_seconds() * 1000
 
         status_ok()
         metric_bool(PLUGIN, 'heat_api_local_status', is_up,
@@ -101,11 +120,13 @@ def check():
                    graphite_host=CONFIGS['graphite_host'],
                    graphite_port=CONFIGS['graphite_port'])
     except:
-        metric_bool(PLUGIN, 'heat_api_local_status', is_up,
+        metric_bool(PLUGIN, 'heat_api_local_status', False,
                     graphite_host=CONFIGS['graphite_host'],
                     graphite_port=CONFIGS['graphite_port'])
         raise
+    finally:
+        flush_metrics()
 
 # register callbacks
 collectd.register_config(configure_callback)
-collectd.register_read(check)
+collectd.register_read(run_in_background(PLUGIN, check, CONFIGS))
@@ -14,27 +14,47 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import time
-
 from keystoneclient.openstack.common.apiclient import exceptions as exc
+from maas_common import APIRequest
+from maas_common import configure_graphite
+from maas_common import flush_metrics
+from maas_common import get_api_poller
 from maas_common import get_auth_details
+from maas_common import get_auth_ref
+from maas_common import get_endpoint_url_for_service
 from maas_common import get_keystone_client
 from maas_common import metric
 from maas_common import metric_bool
+from maas_common import run_in_background
 from maas_common import status_err
 from maas_common import status_ok
+from maas_common import SPOOL_MAX_BYTES
+from requests import exceptions as requests_exc
 import collectd
 
 CONFIGS = {}
 PLUGIN = 'keystone_api_local_check'
+# auth version -> (name, path, params, listed key) of the services probe and
+# the project and user listings
+LISTINGS = {
+    '2': [('services', 'OS-KSADM/services', None, 'OS-KSADM:services'),
+          ('projects', 'tenants', None, 'tenants'),
+          ('users', 'users', None, 'users')],
+    '3': [('services', 'services', None, 'services'),
+          ('projects', 'projects', None, 'projects'),
+          ('users', 'users', {'domain_id': 'Default'}, 'users')]
+}
 
 
 def configure_callback(conf):
     """Receive configuration block"""
     ip = None
     interval = 10
+    timeout = 10
     graphite_host = None
     graphite_port = None
+    graphite_protocol = 'plaintext'
+    graphite_spool_size = SPOOL_MAX_BYTES
 
     for node in conf.children:
         key = node.key
@@ -44,10 +64,16 @@ def configure_callback(conf):
             ip = val
         elif key == 'interval':
             interval = val
+        elif key == 'timeout':
+            timeout = val
         elif key == 'graphite_host':
             graphite_host = val
         elif key == 'graphite_port':
             graphite_port = val
+        elif key == 'graphite_protocol':
+            graphite_protocol = val
+        elif key == 'graphite_spool_size':
+            graphite_spool_size = val
         else:
             collectd.warning('keystone_api_local_check: Unknown config key: {}'
                              .format(key))
@@ -57,8 +83,21 @@ def configure_callback(conf):
     CONFIGS['ip'] = ip
     CONFIGS['auth_details'] = auth_details
     CONFIGS['interval'] = interval
+    CONFIGS['timeout'] = timeout
     CONFIGS['graphite_host'] = graphite_host
     CONFIGS['graphite_port'] = graphite_port
+    configure_graphite(graphite_host, graphite_port, graphite_protocol,
+                       graphite_spool_size)
+
+
+def count_items(key):
+    """Build a reducer returning (milliseconds, items listed under key)."""
+    def reducer(response):
+        if not response.ok:
+            return None
+        return (response.elapsed.total_seconds() * 1000,
+                len(response.json()[key]))
+    return reducer
 
 
 def check():
@@ -71,31 +110,31 @@ def check():
             IDENTITY_ENDPOINT = 'http://{ip}:35357/v3'.format(ip=CONFIGS['ip'])
 
         try:
-            if CONFIGS['ip']:
-                keystone = get_keystone_client(endpoint=IDENTITY_ENDPOINT)
-            else:
-                keystone = get_keystone_client()
-
-            is_up = True
-        except (exc.HttpServerError, exc.ClientException):
+            keystone = get_keystone_client()
+            auth_token = keystone.auth_token
+            if not CONFIGS['ip']:
+                auth_ref = get_auth_ref()
+                IDENTITY_ENDPOINT = get_endpoint_url_for_service(
+                    'identity', auth_ref, 'admin',
+                    version=auth_ref['version']).rstrip('/')
+
+            # time something arbitrary, and gather some vaguely interesting
+            # metrics to return at the same time
+            version = '2' if auth_details['OS_AUTH_VERSION'] == '2' else '3'
+            polled = get_api_poller().poll(auth_token, [
+                APIRequest(name, '%s/%s' % (IDENTITY_ENDPOINT, path), params,
+                           count_items(key))
+                for name, path, params, key in LISTINGS[version]
+            ], timeout=10)
+            is_up = None not in polled.values()
+        except (exc.HttpServerError, exc.ClientException,
+                requests_exc.ConnectionError,
+                requests_exc.HTTPError,
+                requests_exc.Timeout):
             is_up = False
         # Any other exception presumably isn't an API error
         except Exception as e:
             status_err(str(e))
-        else:
-            # time something arbitrary
-            start = time.time()
-            keystone.services.list()
-            end = time.time()
-            milliseconds = (end - start) * 1000
-
-            # gather some vaguely interesting metrics to return
-            if auth_details['OS_AUTH_VERSION'] == '2':
-                project_count = len(keystone.tenants.list())
-                user_count = len(keystone.users.list())
-            else:
-                project_count = len(keystone.projects.list())
-                user_count = len(keystone.users.list(domain='Default'))
 
         status_ok()
         metric_bool(PLUGIN, 'keystone_api_local_status', is_up,
@@ -103,6 +142,9 @@ def check():
                     graphite_port=CONFIGS['graphite_port'])
         # only want to send other metrics if api is up
         if is_up:
+            milliseconds = polled['services'][0]
+            project_count = polled['projects'][1]
+            user_count = polled['users'][1]
             metric(PLUGIN,
                    'keystone_api_local_response_time',
                    '%.3f' % milliseconds,
@@ -119,8 +161,10 @@ def check():
                     graphite_host=CONFIGS['graphite_host'],
                     graphite_port=CONFIGS['graphite_port'])
         raise
+    finally:
+        flush_metrics()
 
 
 # register callbacks
 collectd.register_config(configure_callback)
-collectd.register_read(check)
+collectd.register_read(run_in_background(PLUGIN, check, CONFIGS))
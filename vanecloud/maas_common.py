@@ -15,16 +15,32 @@
 # limitations under the License.
 from __future__ import print_function
 
-import datetime
+import calendar
+import collections
 import time
 import errno
+import fcntl
 import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
+import pickle
 import re
 import sys
 import collectd
 import socket
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import struct
+import tempfile
+import threading
+import traceback
+try:
+    import urlparse
+except ImportError:
+    import urllib.parse as urlparse
 
 AUTH_DETAILS = {'OS_USERNAME': None,
                 'OS_PASSWORD': None,
@@ -46,6 +62,7 @@ AUTH_DETAILS = {'OS_USERNAME': None,
 
 OPENRC = '/root/openrc-maas'
 TOKEN_FILE = '/root/.auth_ref.json'
+TOKEN_LOCK_FILE = '/root/.auth_ref.json.lock'
 
 
 try:
@@ -57,34 +74,65 @@ except ImportError:
         status_err('Cannot import cinderclient')
 else:
 
-    def get_cinder_client(previous_tries=0):
+    def get_cinder_client(token=None, endpoint=None, previous_tries=0):
         if previous_tries > 3:
             return None
-        # right now, cinderclient does not accept a previously derived token
-        # or endpoint url. So we have to pass it creds and let it do it's own
-        # auth each time it's called.
-        # NOTE: (mancdaz) update when https://review.openstack.org/#/c/74602/
-        # lands
 
+        # first try to use auth details from auth_ref so we
+        # don't need to auth with keystone every time
+        auth_ref = get_auth_ref()
         auth_details = get_auth_details()
+        keystone = get_keystone_client(auth_ref)
+
+        if not token:
+            token = keystone.auth_token
+        if not endpoint:
+            endpoint = get_endpoint_url_for_service('volumev2',
+                                                    auth_ref,
+                                                    get_endpoint_type(
+                                                        auth_details))
+
+        cinder = get_cached_client('volumev2', endpoint, token)
+        if cinder is not None:
+            return cinder
+
         cinder = c_client.Client('2',
-                                 auth_details['OS_USERNAME'],
-                                 auth_details['OS_PASSWORD'],
-                                 auth_details['OS_TENANT_NAME'],
-                                 auth_details['OS_AUTH_URL'],
                                  insecure=auth_details['OS_API_INSECURE'],
                                  endpoint_type=auth_details[
                                      'OS_ENDPOINT_TYPE'])
+        # cinderclient only authenticates when it has no token or management
+        # url yet, so handing it ours skips the username/password auth
+        cinder.client.auth_token = token
+        cinder.client.management_url = endpoint
 
         try:
-            # Do something just to ensure we actually have auth'd ok
-            volumes = cinder.volumes.list()
+            # A single non-detailed volume proves we have auth'd ok and costs
+            # the same no matter how many volumes there are
+            volumes = cinder.volumes.list(detailed=False,
+                                          search_opts={'limit': 1})
             # Exceptions are only thrown when we iterate over volumes
             [i.id for i in volumes]
-        except (c_exc.Unauthorized, c_exc.AuthorizationFailure) as e:
-            cinder = get_cinder_client(previous_tries + 1)
+        except (c_exc.Unauthorized, c_exc.AuthorizationFailure,
+                AttributeError) as e:
+            # NOTE: like nova, cinderclient tries to re-auth by itself on a
+            # bad token and fails as it has no credentials to do so
+            invalidate_clients(token)
+            auth_ref = force_reauth(token)
+            keystone = get_keystone_client(auth_ref)
+            token = keystone.auth_token
+
+            cinder = get_cinder_client(token, endpoint, previous_tries + 1)
+        # we only want to pass ClientException back to the calling poller
+        # since this encapsulates all of our actual API failures. Other
+        # exceptions will be treated as script/environmental issues and
+        # sent to status_err
+        except c_exc.ClientException:
+            raise
         except Exception as e:
             status_err(str(e))
+        else:
+            cache_client('volumev2', endpoint, token, cinder,
+                         get_token_expiry(auth_ref))
 
         return cinder
 
@@ -113,6 +161,10 @@ else:
                                                     get_endpoint_type(
                                                         auth_details))
 
+        glance = get_cached_client('image', endpoint, token)
+        if glance is not None:
+            return glance
+
         glance = g_client.Client('1', endpoint=endpoint, token=token)
 
         try:
@@ -122,7 +174,8 @@ else:
             # Exceptions are only thrown when we iterate over image
             [i.id for i in image]
         except g_exc.HTTPUnauthorized:
-            auth_ref = force_reauth()
+            invalidate_clients(token)
+            auth_ref = force_reauth(token)
             keystone = get_keystone_client(auth_ref)
             token = keystone.auth_token
 
@@ -135,6 +188,9 @@ else:
             raise
         except Exception as e:
             status_err(str(e))
+        else:
+            cache_client('image', endpoint, token, glance,
+                         get_token_expiry(auth_ref))
 
         return glance
 
@@ -163,6 +219,10 @@ else:
                                                       get_endpoint_type(
                                                           auth_details))
 
+        nova = get_cached_client('compute', bypass_url, auth_token)
+        if nova is not None:
+            return nova
+
         nova = nova_client.Client('2', auth_token=auth_token,
                                   bypass_url=bypass_url,
                                   insecure=auth_details['OS_API_INSECURE'])
@@ -178,7 +238,8 @@ else:
             # in fact tries to re-auth, all by itself. But we didn't pass it
             # an auth_url, so it bombs out horribly with an error.
 
-            auth_ref = force_reauth()
+            invalidate_clients(auth_token)
+            auth_ref = force_reauth(auth_token)
             keystone = get_keystone_client(auth_ref)
             auth_token = keystone.auth_token
 
@@ -192,6 +253,9 @@ else:
             raise
         except Exception as e:
             status_err(str(e))
+        else:
+            cache_client('compute', bypass_url, auth_token, nova,
+                         get_token_expiry(auth_ref))
 
         return nova
 
@@ -220,13 +284,14 @@ else:
         except Exception as e:
             status_err(str(e))
 
+        mtime = None
         try:
-            with open(TOKEN_FILE, 'w') as token_file:
-                json.dump(keystone.auth_ref, token_file)
-        except IOError:
+            mtime = write_auth_ref(keystone.auth_ref)
+        except (IOError, OSError):
             # if we can't write the file we go on
             pass
 
+        cache_auth_ref(keystone.auth_ref, mtime)
         return keystone.auth_ref
 
     def get_keystone_client(auth_ref=None, endpoint=None, previous_tries=0):
@@ -234,8 +299,10 @@ else:
             return None
 
         # first try to use auth details from auth_ref so we
-        # don't need to auth with keystone every time
-        if not auth_ref:
+        # don't need to auth with keystone every time. Plugins hold on to
+        # the auth_ref they got at configure time, so once that has expired
+        # switch to the current one rather than re-authenticating every poll
+        if not auth_ref or get_token_expiry(auth_ref) <= time.time():
             auth_ref = get_auth_ref()
 
         auth_version = auth_ref['version']
@@ -243,6 +310,11 @@ else:
             endpoint = get_endpoint_url_for_service('identity', auth_ref,
                                                     'admin',
                                                     version=auth_version)
+        token = get_auth_token(auth_ref)
+        keystone = get_cached_client('identity', endpoint, token)
+        if keystone is not None:
+            return keystone
+
         if auth_version == 'v3':
             k_client = k3_client
         else:
@@ -255,7 +327,8 @@ else:
             keystone.services.list()
         except (k_exc.AuthorizationFailure, k_exc.Unauthorized):
             # Force an update of auth_ref
-            auth_ref = force_reauth()
+            invalidate_clients(token)
+            auth_ref = force_reauth(token)
             keystone = get_keystone_client(auth_ref,
                                            endpoint,
                                            previous_tries + 1)
@@ -263,6 +336,9 @@ else:
             raise
         except Exception as e:
             status_err(str(e))
+        else:
+            cache_client('identity', endpoint, token, keystone,
+                         get_token_expiry(auth_ref))
 
         return keystone
 
@@ -292,6 +368,10 @@ else:
                                                         get_endpoint_type(
                                                             auth_details))
 
+        neutron = get_cached_client('network', endpoint_url, token)
+        if neutron is not None:
+            return neutron
+
         neutron = n_client.Client('2.0',
                                   token=token,
                                   endpoint_url=endpoint_url,
@@ -308,7 +388,8 @@ else:
         # jazz. Since we want to auth again ourselves (so we can update our
         # local token) we'll just catch the exception it throws and move on
         except n_exc.NoAuthURLProvided:
-            auth_ref = force_reauth()
+            invalidate_clients(token)
+            auth_ref = force_reauth(token)
             keystone = get_keystone_client(auth_ref)
             token = keystone.auth_token
 
@@ -323,6 +404,9 @@ else:
             raise
         except Exception as e:
             status_err(str(e))
+        else:
+            cache_client('network', endpoint_url, token, neutron,
+                         get_token_expiry(auth_ref))
 
         return neutron
 
@@ -352,6 +436,10 @@ else:
                                                     get_endpoint_type(
                                                         auth_details))
 
+        heat = get_cached_client('orchestration', endpoint, token)
+        if heat is not None:
+            return heat
+
         heat = heat_client.Client('1',
                                   endpoint=endpoint,
                                   token=token,
@@ -359,7 +447,8 @@ else:
         try:
             heat.build_info.build_info()
         except h_exc.HTTPUnauthorized:
-            auth_ref = force_reauth()
+            invalidate_clients(token)
+            auth_ref = force_reauth(token)
             keystone = get_keystone_client(auth_ref)
 
             token = keystone.auth_token
@@ -368,6 +457,9 @@ else:
             raise
         except Exception as e:
             status_err(str(e))
+        else:
+            cache_client('orchestration', endpoint, token, heat,
+                         get_token_expiry(auth_ref))
 
         return heat
 
@@ -376,21 +468,76 @@ class MaaSException(Exception):
     """Base MaaS plugin exception."""
 
 
-def is_token_expired(token, auth_details):
+# Validated API clients, keyed by (service_type, endpoint, token). An entry
+# lives until CLIENT_CACHE_TTL passes or the token is rejected, so the
+# validation request in each get_*_client factory runs once per token
+# instead of once per poll. Expired tokens never get looked up again since
+# get_auth_ref hands out a new token, and caching a client for a new token
+# drops the ones held for the old token on the same endpoint.
+CLIENT_CACHE_TTL = 3600
+CLIENT_CACHE = {}
+CLIENT_CACHE_LOCK = threading.Lock()
+
+
+def get_auth_token(auth_ref):
+    if 'auth_token' in auth_ref:
+        return auth_ref['auth_token']
+    # Keystone v2.0's auth-ref format
+    return auth_ref['token']['id']
+
+
+def get_cached_client(service_type, endpoint, token):
+    key = (service_type, endpoint, token)
+    with CLIENT_CACHE_LOCK:
+        entry = CLIENT_CACHE.get(key)
+        if entry is None:
+            return None
+        client, expires = entry
+        if time.time() >= expires:
+            del CLIENT_CACHE[key]
+            return None
+        return client
+
+
+def cache_client(service_type, endpoint, token, client, expires=None):
+    """Remember a validated client until expires, capped at the cache TTL."""
+    ttl_expiry = time.time() + CLIENT_CACHE_TTL
+    if expires is None or expires > ttl_expiry:
+        expires = ttl_expiry
+    with CLIENT_CACHE_LOCK:
+        for key in list(CLIENT_CACHE):
+            if key[:2] == (service_type, endpoint) and key[2] != token:
+                del CLIENT_CACHE[key]
+        CLIENT_CACHE[(service_type, endpoint, token)] = (client, expires)
+
+
+def invalidate_clients(token=None):
+    """Forget cached clients using token, or every client if it is None."""
+    with CLIENT_CACHE_LOCK:
+        for key in list(CLIENT_CACHE):
+            if token is None or key[2] == token:
+                del CLIENT_CACHE[key]
+
+
+def get_token_expiry(auth_ref):
+    """Return when the token in auth_ref expires, as a unix timestamp."""
+    cached_ref, expires, _ = AUTH_REF_CACHE
+    if auth_ref is cached_ref:
+        return expires
+    if auth_ref.get('version') == 'v3':
+        expires_at = auth_ref.get('expires_at')
+    else:
+        expires_at = auth_ref['token'].get('expires')
     for fmt in ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ'):
         try:
-            if auth_details['OS_AUTH_URL'].endswith('v3'):
-                expires_at = token.get('expires_at')
-            else:
-                expires_at = token['token'].get('expires')
-
-            expires = datetime.datetime.strptime(expires_at, fmt)
-            break
-        except ValueError as e:
+            return calendar.timegm(time.strptime(expires_at, fmt))
+        except ValueError:
             pass
-    else:
-        raise e
-    return datetime.datetime.now() >= expires
+    raise ValueError('Cannot parse token expiry %s' % expires_at)
+
+
+def is_token_expired(token, auth_details=None):
+    return time.time() >= get_token_expiry(token)
 
 
 def get_service_catalog(auth_ref):
@@ -408,34 +555,138 @@ def get_endpoint_type(auth_details):
     return 'internal'
 
 
+# (auth_ref, expiry as a unix timestamp, TOKEN_FILE mtime) for the parsed
+# contents of TOKEN_FILE, so get_auth_ref only goes back to the file when
+# another process has written a new token to it. Always replaced as a whole
+# so readers never see parts of two different tokens.
+AUTH_REF_CACHE = (None, 0, None)
+# how long before the token expires a new one is fetched in the background
+AUTH_REF_REFRESH_MARGIN = 300
+AUTH_REF_REFRESHING = threading.Event()
+REAUTH_LOCK = threading.Lock()
+
+AUTH_DETAILS_CACHE = {}
+
+
+def cache_auth_ref(auth_ref, mtime=None):
+    global AUTH_REF_CACHE
+    AUTH_REF_CACHE = (auth_ref, get_token_expiry(auth_ref), mtime)
+
+
+def refresh_auth_ref(auth_ref):
+    """Fetch a new token in the background unless that is underway."""
+    if AUTH_REF_REFRESHING.is_set():
+        return
+    AUTH_REF_REFRESHING.set()
+
+    stale_token = get_auth_token(auth_ref)
+
+    def refresh():
+        try:
+            reauth(stale_token, AUTH_REF_REFRESH_MARGIN)
+        except (Exception, SystemExit) as e:
+            logging.error('Background token refresh failed: %s', e)
+        finally:
+            AUTH_REF_REFRESHING.clear()
+
+    thread = threading.Thread(target=refresh, name='maas-auth-refresh')
+    thread.daemon = True
+    thread.start()
+
+
+def token_is_usable(auth_ref, stale_token=None, margin=0):
+    return (auth_ref is not None and
+            get_auth_token(auth_ref) != stale_token and
+            get_token_expiry(auth_ref) - time.time() > margin)
+
+
+def reauth(stale_token=None, margin=0):
+    """Authenticate with keystone once, however many callers need a token.
+
+    Plugin threads queue up on REAUTH_LOCK and other processes on an flock
+    of TOKEN_LOCK_FILE. Whoever gets there first authenticates, the rest
+    find a token other than stale_token that is still good for more than
+    margin seconds and use that instead of authenticating again.
+    """
+    with REAUTH_LOCK:
+        auth_ref = AUTH_REF_CACHE[0]
+        if token_is_usable(auth_ref, stale_token, margin):
+            return auth_ref
+
+        try:
+            lock_file = open(TOKEN_LOCK_FILE, 'a')
+        except IOError:
+            lock_file = None
+        try:
+            if lock_file is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                auth_ref = get_auth_from_file()
+                if token_is_usable(auth_ref, stale_token, margin):
+                    return auth_ref
+            return keystone_auth(get_auth_details())
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+
+
+def write_auth_ref(auth_ref):
+    """Atomically replace TOKEN_FILE, returning the new file's mtime."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(TOKEN_FILE),
+                               prefix='.auth_ref.')
+    try:
+        with os.fdopen(fd, 'w') as token_file:
+            json.dump(auth_ref, token_file)
+        os.rename(tmp, TOKEN_FILE)
+    except Exception:
+        os.remove(tmp)
+        raise
+    return os.stat(TOKEN_FILE).st_mtime
+
+
 def get_auth_ref():
-    auth_details = get_auth_details()
     auth_ref = get_auth_from_file()
     if auth_ref is None:
-        auth_ref = keystone_auth(auth_details)
+        return reauth()
 
-    if is_token_expired(auth_ref, auth_details):
-        auth_ref = keystone_auth(auth_details)
+    remaining = get_token_expiry(auth_ref) - time.time()
+    if remaining <= 0:
+        auth_ref = reauth(get_auth_token(auth_ref))
+    elif remaining <= AUTH_REF_REFRESH_MARGIN:
+        refresh_auth_ref(auth_ref)
 
     return auth_ref
 
 
 def get_auth_from_file():
+    cached_ref, _, cached_mtime = AUTH_REF_CACHE
     try:
+        mtime = os.stat(TOKEN_FILE).st_mtime
+        if cached_ref is not None and cached_mtime == mtime:
+            return cached_ref
+
         with open(TOKEN_FILE) as token_file:
             auth_ref = json.load(token_file)
 
+        cache_auth_ref(auth_ref, mtime)
         return auth_ref
-    except IOError as e:
+    except (IOError, OSError) as e:
         if e.errno == errno.ENOENT:
-            return None
+            return cached_ref
         status_err(e)
     except ValueError:  # No JSON object could be decoded
         return None
 
 
 def get_auth_details(openrc_file=OPENRC):
-    auth_details = AUTH_DETAILS
+    try:
+        mtime = os.stat(openrc_file).st_mtime
+    except OSError:
+        mtime = None
+    cached = AUTH_DETAILS_CACHE.get(openrc_file)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    auth_details = dict(AUTH_DETAILS)
     pattern = re.compile(
         '^(?:export\s)?(?P<key>\w+)(?:\s+)?=(?:\s+)?(?P<value>.*)$'
     )
@@ -461,6 +712,7 @@ def get_auth_details(openrc_file=OPENRC):
         if auth_details[key] is None:
             status_err('%s not set' % key)
 
+    AUTH_DETAILS_CACHE[openrc_file] = (mtime, auth_details)
     return auth_details
 
 
@@ -471,30 +723,84 @@ def get_url_for_type(endpoint, url_type, auth_version):
         return endpoint[url_type + 'URL']
 
 
+# token -> ({(service_type, interface): [url, ...]},
+#           {(service_type, interface, version): url})
+# A few tokens are kept since plugins may still hold the auth_ref they got
+# at configure time while others have moved on to a refreshed one.
+CATALOG_INDEXES = {}
+CATALOG_INDEXES_SIZE = 4
+
+
+def build_catalog_index(auth_ref):
+    """Map (service_type, interface) to its endpoint urls in catalog order."""
+    auth_version = auth_ref['version']
+    urls = {}
+    for service in get_service_catalog(auth_ref):
+        for endpoint in service['endpoints']:
+            if auth_version == 'v3':
+                interfaces = [endpoint['interface']]
+            else:
+                interfaces = [key[:-3] for key in endpoint
+                              if key.endswith('URL')]
+            for interface in interfaces:
+                url = get_url_for_type(endpoint, interface, auth_version)
+                if url is not None:
+                    urls.setdefault((service['type'], interface),
+                                    []).append(url)
+    return urls
+
+
+def get_catalog_index(auth_ref):
+    token = get_auth_token(auth_ref)
+    index = CATALOG_INDEXES.get(token)
+    if index is None:
+        if len(CATALOG_INDEXES) >= CATALOG_INDEXES_SIZE:
+            CATALOG_INDEXES.clear()
+        index = (build_catalog_index(auth_ref), {})
+        CATALOG_INDEXES[token] = index
+    return index
+
+
 def get_endpoint_url_for_service(service_type, auth_ref,
                                  url_type='public', version=None):
     # version = the version identifier on the end of the url. eg:
     # for keystone admin api v3:
     # http://172.29.236.3:35357/v3
     # so you'd pass version='v3'
-    service_catalog = get_service_catalog(auth_ref)
-    auth_version = auth_ref['version']
+    urls, lookups = get_catalog_index(auth_ref)
+    key = (service_type, url_type, version)
+    if key not in lookups:
+        for url in urls.get((service_type, url_type), []):
+            # If version is not provided or it is provided and the url
+            # ends with it, we want to return it, otherwise we want to
+            # do nothing.
+            if not version or url.endswith(version):
+                lookups[key] = url
+                break
+        else:
+            lookups[key] = None
+    return lookups[key]
+
+
+def force_reauth(stale_token=None):
+    """Replace a token keystone rejected, see reauth."""
+    if stale_token is None and AUTH_REF_CACHE[0] is not None:
+        stale_token = get_auth_token(AUTH_REF_CACHE[0])
+    return reauth(stale_token)
 
-    for service in service_catalog:
-        if service['type'] == service_type:
-            for endpoint in service['endpoints']:
-                url = get_url_for_type(endpoint, url_type, auth_version)
-                if url is not None:
-                    # If version is not provided or it is provided and the url
-                    # ends with it, we want to return it, otherwise we want to
-                    # do nothing.
-                    if not version or url.endswith(version):
-                        return url
 
+def reject_token(token=None):
+    """Forget the clients built on a token an API has just refused.
 
-def force_reauth():
-    auth_details = get_auth_details()
-    return keystone_auth(auth_details)
+    Cached clients are only validated when they are built, so a token
+    revoked before it expires first shows up as Unauthorized from a check's
+    own calls. Checks call this when that happens; the clients are evicted
+    and the token replaced, so the next cycle starts afresh.
+    """
+    if token is None and AUTH_REF_CACHE[0] is not None:
+        token = get_auth_token(AUTH_REF_CACHE[0])
+    invalidate_clients(token)
+    return force_reauth(token)
 
 
 STATUS = ''
@@ -564,13 +870,698 @@ def dispatch_value(plugin_name, key, value, plugin_instance=None,
         val.dispatch()
 
 
+# Keep each datagram comfortably below a 1500 byte ethernet MTU so carbon
+# never has to deal with fragmented packets
+GRAPHITE_MAX_DATAGRAM = 1400
+# carbon's pickle receiver refuses frames larger than 1MB
+GRAPHITE_MAX_PICKLE_FRAME = 512 * 1024
+GRAPHITE_TCP_TIMEOUT = 2
+GRAPHITE_BACKOFF_MIN = 1
+GRAPHITE_BACKOFF_MAX = 60
+
+SPOOL_DIR = '/var/lib/vanecloud/spool'
+SPOOL_MAX_BYTES = 64 * 1024 * 1024
+# seconds a flush may spend replaying the spool before it gives up the turn
+SPOOL_REPLAY_BUDGET = 0.5
+# bytes of spool read back at a time while replaying
+SPOOL_REPLAY_BLOCK = 64 * 1024
+
+
+class MetricSpool(object):
+    """Bounded FIFO of plaintext metric lines, kept in segment files.
+
+    Lines are appended to the newest segment, path.<n>, and a new segment is
+    started once it holds a quarter of max_bytes. Replay reads the oldest
+    segment a block at a time from a byte offset saved in path.offset, and
+    each segment is deleted once it has been sent. When the spool outgrows
+    max_bytes its oldest segment is dropped, so neither replay nor eviction
+    ever reads or rewrites the whole spool.
+    """
+
+    def __init__(self, path, max_bytes=SPOOL_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.sizes = {}
+        self.offset = 0
+        try:
+            # spools written before segmenting are a single file
+            if os.path.isfile(path):
+                os.rename(path, path + '.0')
+            prefix = os.path.basename(path) + '.'
+            for name in os.listdir(os.path.dirname(path)):
+                if name.startswith(prefix) and name[len(prefix):].isdigit():
+                    self.sizes[int(name[len(prefix):])] = os.path.getsize(
+                        os.path.join(os.path.dirname(path), name))
+        except OSError:
+            pass
+        self.segments = sorted(self.sizes)
+        self.next_segment = self.segments[-1] + 1 if self.segments else 0
+        try:
+            with open(path + '.offset') as offset_file:
+                segment, offset = [int(i) for i in offset_file.read().split()]
+            if self.segments and segment == self.segments[0]:
+                self.offset = min(offset, self.sizes[segment])
+        except (IOError, OSError, ValueError):
+            pass
+        # bytes waiting to be replayed
+        self.size = sum(self.sizes.values()) - self.offset
+
+    def _segment_path(self, segment):
+        return '%s.%d' % (self.path, segment)
+
+    def _save_offset(self):
+        try:
+            if self.segments:
+                with open(self.path + '.offset', 'w') as offset_file:
+                    offset_file.write('%d %d' % (self.segments[0],
+                                                 self.offset))
+            elif os.path.exists(self.path + '.offset'):
+                os.remove(self.path + '.offset')
+        except (IOError, OSError) as e:
+            logging.error('Cannot save metric spool offset %s: %s',
+                          self.path, e)
+
+    def _drop_oldest(self):
+        segment = self.segments.pop(0)
+        self.size -= self.sizes.pop(segment) - self.offset
+        self.offset = 0
+        try:
+            os.remove(self._segment_path(segment))
+        except OSError:
+            pass
+        self._save_offset()
+
+    def append(self, lines):
+        if not lines or not self.max_bytes:
+            return
+        data = ''.join(line + '\n' for line in lines)
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            if (not self.segments or
+                    self.sizes[self.segments[-1]] >= self.max_bytes // 4):
+                self.segments.append(self.next_segment)
+                self.sizes[self.next_segment] = 0
+                self.next_segment += 1
+            segment = self.segments[-1]
+            with open(self._segment_path(segment), 'a') as spool:
+                spool.write(data)
+            self.sizes[segment] += len(data)
+            self.size += len(data)
+        except (IOError, OSError) as e:
+            logging.error('Dropping %d metrics, cannot spool to %s: %s',
+                          len(lines), self.path, e)
+            return
+        if sum(self.sizes.values()) > self.max_bytes and \
+                len(self.segments) > 1:
+            logging.warning('Metric spool %s is full, evicting oldest '
+                            'metrics', self.path)
+            while sum(self.sizes.values()) > self.max_bytes and \
+                    len(self.segments) > 1:
+                self._drop_oldest()
+
+    def read(self, block_bytes=SPOOL_REPLAY_BLOCK):
+        """Return the oldest unsent lines, up to about block_bytes of them.
+
+        Lines are returned as spooled; a crash mid-append can leave a
+        malformed one behind, which the caller should skip and consume.
+        """
+        if not self.segments:
+            return []
+        try:
+            with open(self._segment_path(self.segments[0]), 'rb') as spool:
+                spool.seek(self.offset)
+                data = spool.read(block_bytes)
+        except (IOError, OSError) as e:
+            logging.error('Cannot read metric spool %s: %s', self.path, e)
+            data = ''
+        if not data:
+            # missing or truncated behind our back
+            self._drop_oldest()
+            return []
+        if len(data) == block_bytes and data.rfind('\n') >= 0:
+            data = data[:data.rfind('\n') + 1]
+        return data.split('\n')[:-1] if data.endswith('\n') \
+            else data.split('\n')
+
+    def consume(self, nbytes):
+        """Mark nbytes from the front of the spool as sent."""
+        segment = self.segments[0]
+        offset = min(self.offset + nbytes, self.sizes[segment])
+        self.size -= offset - self.offset
+        self.offset = offset
+        if offset >= self.sizes[segment]:
+            self.offset = 0
+            self.segments.pop(0)
+            del self.sizes[segment]
+            try:
+                os.remove(self._segment_path(segment))
+            except OSError:
+                pass
+        self._save_offset()
+
+
+class GraphiteSender(object):
+    """Batch plaintext metric lines into as few UDP datagrams as possible.
+
+    One sender exists per (graphite_host, graphite_port) and its socket is
+    reused for the lifetime of the collectd process. Lines are buffered until
+    the next line would overflow max_payload or flush() is called.
+
+    Lines that cannot be delivered go to a MetricSpool and are replayed, in
+    the order they were spooled, by later flushes once carbon accepts data
+    again. UDP only reports a failure when the kernel has one to give, such
+    as an ICMP port unreachable for an earlier datagram, so with the
+    plaintext transport a carbon that is down or unreachable usually goes
+    unnoticed and nothing is spooled. Use the pickle transport when metrics
+    must survive carbon outages.
+    """
+
+    def __init__(self, host, port, max_payload=GRAPHITE_MAX_DATAGRAM,
+                 spool_max_bytes=SPOOL_MAX_BYTES):
+        self.address = (host, int(port))
+        self.max_payload = max_payload
+        self.lock = threading.Lock()
+        self.sock = None
+        self.buffer = []
+        self.buffered = 0
+        self.lines_sent = 0
+        self.datagrams_sent = 0
+        self.bytes_sent = 0
+        self.spool = MetricSpool(
+            os.path.join(SPOOL_DIR, 'graphite_%s_%s.spool' % self.address),
+            spool_max_bytes)
+
+    def _open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect(self.address)
+        return sock
+
+    def _connect(self):
+        if self.sock is None:
+            self.sock = self._open_socket()
+        return self.sock
+
+    def _close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+    def _valid(self, line):
+        return len(line.split()) == 3
+
+    def _payload(self, lines):
+        return ''.join(line + '\n' for line in lines)
+
+    def _chunks(self, lines):
+        chunk = []
+        size = 0
+        for line in lines:
+            if chunk and size + len(line) + 1 > self.max_payload:
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(line)
+            size += len(line) + 1
+        if chunk:
+            yield chunk
+
+    def _write(self, lines):
+        payload = self._payload(lines)
+        try:
+            self._connect().sendall(payload)
+        except socket.error:
+            # drop the socket so the next payload gets a fresh one
+            self._close()
+            raise
+        self.lines_sent += len(lines)
+        self.datagrams_sent += 1
+        self.bytes_sent += len(payload)
+
+    def _ready(self):
+        return True
+
+    def _failed(self, error):
+        logging.warning('Cannot send metrics to carbon at %s:%s, spooling: '
+                        '%s', self.address[0], self.address[1], error)
+
+    def _succeeded(self):
+        pass
+
+    def _deliver(self, lines, deadline=None):
+        """Write lines out and return how many of them were sent."""
+        sent = 0
+        try:
+            for chunk in self._chunks(lines):
+                if deadline is not None and time.time() > deadline:
+                    break
+                self._write(chunk)
+                sent += len(chunk)
+        except socket.error as e:
+            self._failed(e)
+            return sent
+        self._succeeded()
+        return sent
+
+    def _replay(self):
+        deadline = time.time() + SPOOL_REPLAY_BUDGET
+        while self.spool.size > 0 and time.time() < deadline:
+            lines = self.spool.read()
+            valid = [line for line in lines if self._valid(line)]
+            sent = self._deliver(valid, deadline)
+            # consume up to the first unsent line, malformed ones included
+            consumed = 0
+            for line in lines:
+                if self._valid(line):
+                    if not sent:
+                        break
+                    sent -= 1
+                consumed += len(line) + 1
+            if consumed:
+                self.spool.consume(consumed)
+            if consumed < sum(len(line) + 1 for line in lines):
+                break
+
+    def _send_buffer(self):
+        if not self.buffer:
+            return
+        lines = self.buffer
+        self.buffer = []
+        self.buffered = 0
+        if not self._ready():
+            self.spool.append(lines)
+            return
+        sent = self._deliver(lines)
+        if sent < len(lines):
+            self.spool.append(lines[sent:])
+        elif self.spool.size:
+            self._replay()
+
+    def send(self, line):
+        line = line.rstrip('\n')
+        if not self._valid(line):
+            # never buffered, so it can't end up stuck in the spool either
+            logging.warning('Dropping malformed metric line: %r', line)
+            return
+        with self.lock:
+            if self.buffer and \
+                    self.buffered + len(line) + 1 > self.max_payload:
+                self._send_buffer()
+            self.buffer.append(line)
+            self.buffered += len(line) + 1
+
+    def flush(self):
+        with self.lock:
+            self._send_buffer()
+
+    def stats(self):
+        return {'lines': self.lines_sent,
+                'datagrams': self.datagrams_sent,
+                'bytes': self.bytes_sent,
+                'spooled_bytes': self.spool.size}
+
+
+class GraphitePickleSender(GraphiteSender):
+    """Send metrics over a persistent TCP connection to carbon's pickle port.
+
+    Everything buffered during a read cycle goes out as a single pickle frame
+    on flush(). When carbon cannot be reached the metrics are spooled and the
+    connection is retried with an exponential backoff between
+    GRAPHITE_BACKOFF_MIN and GRAPHITE_BACKOFF_MAX seconds.
+    """
+
+    def __init__(self, host, port, max_payload=GRAPHITE_MAX_PICKLE_FRAME,
+                 spool_max_bytes=SPOOL_MAX_BYTES):
+        super(GraphitePickleSender, self).__init__(host, port, max_payload,
+                                                   spool_max_bytes)
+        self.backoff = 0
+        self.next_attempt = 0
+
+    def _open_socket(self):
+        return socket.create_connection(self.address,
+                                        timeout=GRAPHITE_TCP_TIMEOUT)
+
+    def _valid(self, line):
+        try:
+            path, value, timestamp = line.split()
+            float(value)
+            float(timestamp)
+        except ValueError:
+            return False
+        return True
+
+    def _payload(self, lines):
+        metrics = []
+        for line in lines:
+            if not self._valid(line):
+                continue
+            path, value, timestamp = line.split()
+            metrics.append((path, (float(timestamp), float(value))))
+        payload = pickle.dumps(metrics, protocol=2)
+        return struct.pack('!L', len(payload)) + payload
+
+    def _ready(self):
+        return time.time() >= self.next_attempt
+
+    def _failed(self, error):
+        self.backoff = min(max(self.backoff * 2, GRAPHITE_BACKOFF_MIN),
+                           GRAPHITE_BACKOFF_MAX)
+        self.next_attempt = time.time() + self.backoff
+        logging.warning('Cannot send metrics to carbon at %s:%s, spooling '
+                        'and retrying in %ss: %s', self.address[0],
+                        self.address[1], self.backoff, error)
+
+    def _succeeded(self):
+        self.backoff = 0
+        self.next_attempt = 0
+
+
+GRAPHITE_PROTOCOLS = {'plaintext': GraphiteSender,
+                      'pickle': GraphitePickleSender}
+GRAPHITE_SENDERS = {}
+GRAPHITE_SENDERS_LOCK = threading.Lock()
+# seconds between each sender reporting its own counters, see
+# send_graphite_stats
+GRAPHITE_STATS_INTERVAL = 60
+GRAPHITE_STATS_SENT = {'last': 0}
+
+
+def configure_graphite(graphite_host, graphite_port, protocol='plaintext',
+                       spool_max_bytes=SPOOL_MAX_BYTES):
+    """Select the transport used for a graphite_host/graphite_port pair."""
+    if protocol not in GRAPHITE_PROTOCOLS:
+        status_err('Unknown graphite_protocol %s, expected one of %s'
+                   % (protocol, ', '.join(sorted(GRAPHITE_PROTOCOLS))))
+    key = (graphite_host, int(graphite_port))
+    with GRAPHITE_SENDERS_LOCK:
+        sender = GRAPHITE_SENDERS.get(key)
+        if type(sender) is not GRAPHITE_PROTOCOLS[protocol]:
+            sender = GRAPHITE_PROTOCOLS[protocol](graphite_host,
+                                                  graphite_port)
+            GRAPHITE_SENDERS[key] = sender
+        sender.spool.max_bytes = int(spool_max_bytes)
+    return sender
+
+
+def get_graphite_sender(graphite_host, graphite_port):
+    key = (graphite_host, int(graphite_port))
+    with GRAPHITE_SENDERS_LOCK:
+        sender = GRAPHITE_SENDERS.get(key)
+        if sender is None:
+            sender = GraphiteSender(graphite_host, graphite_port)
+            GRAPHITE_SENDERS[key] = sender
+    return sender
+
+
 def send_metric_direct_to_graphite(graphite_host, graphite_port, metric):
-    graphiteSock = socket.socket(socket.AF_INET,
-                                 socket.SOCK_DGRAM)
+    get_graphite_sender(graphite_host, graphite_port).send(metric)
+
+
+def flush_metrics():
+    """Send whatever is still buffered; call at the end of a read callback."""
+    send_graphite_stats()
+    for sender in GRAPHITE_SENDERS.values():
+        sender.flush()
+
+
+def get_graphite_stats():
+    stats = {}
+    for key, sender in GRAPHITE_SENDERS.items():
+        stats['%s:%s' % key] = sender.stats()
+    return stats
+
+
+def send_graphite_stats():
+    """Send each sender's counters through itself every so often.
+
+    They go out as vanecloud.graphite_sender.<host>_<port>.<counter>, at
+    most once every GRAPHITE_STATS_INTERVAL seconds whichever plugin
+    flushes.
+    """
+    now = time.time()
+    with GRAPHITE_SENDERS_LOCK:
+        if now - GRAPHITE_STATS_SENT['last'] < GRAPHITE_STATS_INTERVAL:
+            return
+        GRAPHITE_STATS_SENT['last'] = now
+        senders = list(GRAPHITE_SENDERS.items())
+    for (host, port), sender in senders:
+        name = ('%s_%s' % (host, port)).replace('.', '_')
+        for counter, value in sorted(sender.stats().items()):
+            sender.send('vanecloud.graphite_sender.%s.%s %s %s'
+                        % (name, counter, value, now))
+
+# Read callbacks wrapped with run_in_background share this many threads, so
+# a plugin stuck on a slow API only ever ties up one of them and never one
+# of collectd's own read threads
+CHECK_WORKERS = 4
+# seconds a check may run before its worker is given up on, unless the
+# plugin has a timeout configured
+CHECK_TIMEOUT = 10
+
+
+class CheckExecutor(object):
+    """Run plugin read callbacks on a bounded pool of worker threads.
+
+    A check that is still queued or running when its next interval comes
+    round is skipped for that interval rather than piling up behind itself.
+    Once a check has run for longer than its deadline its worker is
+    abandoned and a fresh one started in its place, so a hung check can't
+    starve the others. Python can't kill a thread, so the abandoned one
+    exits only when the check finally returns, and until then the check
+    is not run again. Checks dispatch their own metrics when they finish.
+    """
+
+    def __init__(self, workers=CHECK_WORKERS):
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.running = {}
+        # thread -> (name, started, deadline) of the check it is running
+        self.active = {}
+        self.threads = []
+        self.spawned = 0
+
+    def _start(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work,
+                                      name='maas-check-%d' % self.spawned)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+            self.spawned += 1
+
+    def _abandon_overdue(self, now):
+        for thread, (name, started, deadline) in self.active.items():
+            if thread in self.threads and now - started > deadline:
+                collectd.warning('%s: still running after %.1fs, replacing '
+                                 'its worker' % (name, now - started))
+                self.threads.remove(thread)
+
+    def _work(self):
+        thread = threading.current_thread()
+        while True:
+            name, func, deadline = self.queue.get()
+            started = time.time()
+            with self.lock:
+                self.active[thread] = (name, started, deadline)
+            try:
+                func()
+            except (Exception, SystemExit):
+                collectd.error('%s: check failed: %s'
+                               % (name, traceback.format_exc()))
+            finally:
+                elapsed = time.time() - started
+                if elapsed > deadline:
+                    collectd.warning('%s: check took %.1fs, longer than its '
+                                     '%.1fs deadline' % (name, elapsed,
+                                                         deadline))
+                with self.lock:
+                    del self.running[name]
+                    del self.active[thread]
+                    if thread not in self.threads:
+                        # replaced while overdue, the new worker carries on
+                        return
+
+    def submit(self, name, func, deadline=CHECK_TIMEOUT):
+        """Queue func unless the previous run of name hasn't finished."""
+        now = time.time()
+        with self.lock:
+            self._abandon_overdue(now)
+            self._start()
+            if name in self.running:
+                elapsed = now - self.running[name]
+                if elapsed > deadline:
+                    collectd.warning('%s: still running after %.1fs, '
+                                     'skipping this interval'
+                                     % (name, elapsed))
+                return False
+            self.running[name] = now
+        self.queue.put((name, func, deadline))
+        return True
+
+
+CHECK_EXECUTOR = CheckExecutor()
+
+
+def run_in_background(name, func, configs=None):
+    """Wrap a read callback so it runs on the shared CheckExecutor.
+
+    The deadline comes from configs['timeout'] when the plugin has one.
+    """
+    def read_callback():
+        deadline = float((configs or {}).get('timeout', CHECK_TIMEOUT))
+        CHECK_EXECUTOR.submit(name, func, deadline)
+    return read_callback
+
+
+APIRequest = collections.namedtuple('APIRequest',
+                                    ['name', 'url', 'params', 'reducer',
+                                     'headers'])
+# extra headers, e.g. an API microversion, are optional
+APIRequest.__new__.__defaults__ = (None,)
+API_POLLER_WORKERS = 8
+API_POLLER = None
+API_POLLER_LOCK = threading.Lock()
+
+
+def next_page(body, key, params):
+    """Return the params of the page after body's, or None if it was last.
+
+    A short page doesn't mean the listing is over, as APIs cap limit at
+    their own maximum (nova's osapi_max_limit). When the API links the
+    next page under <key>_links that link is followed, and there is no
+    next page without one; otherwise the page after the last item is asked
+    for until one comes back empty.
+    """
+    items = body[key]
+    if not items:
+        return None
+    links = body.get('%s_links' % key)
+    if links is None:
+        return dict(params, marker=items[-1]['id'])
+    for link in links:
+        if link.get('rel') == 'next':
+            query = urlparse.urlsplit(link['href']).query
+            return dict(params, **dict(urlparse.parse_qsl(query)))
+    return None
+
+
+try:
+    import requests
+except ImportError:
+    def get_api_poller(*args, **kwargs):
+        status_err('Cannot import requests')
+
+    def count_listing(*args, **kwargs):
+        status_err('Cannot import requests')
+else:
+    class TokenRejected(Exception):
+        """An API answered 401 to the poll's token."""
+
+    class APIPoller(object):
+        """Issue every HTTP request of a poll cycle at the same time.
+
+        Requests go out over one keep-alive session, so connections to each
+        API are pooled between cycles, and a cycle takes about as long as its
+        slowest request instead of the sum of all of them. Plugins describe a
+        cycle as a list of APIRequests; each reducer turns its response into
+        whatever the plugin reports, or the response itself is returned when
+        there is no reducer.
+        """
+
+        def __init__(self, workers=API_POLLER_WORKERS):
+            self.session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=workers,
+                                                    pool_maxsize=workers)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+            self.pool = ThreadPool(workers)
+
+        def _fetch(self, args):
+            request, headers, timeout = args
+            if request.headers:
+                headers = dict(headers, **request.headers)
+            try:
+                response = self.session.get(request.url,
+                                            params=request.params,
+                                            headers=headers,
+                                            verify=False,
+                                            timeout=timeout)
+                if response.status_code == 401:
+                    return None, TokenRejected(response.url)
+                if request.reducer is None:
+                    return response, None
+                return request.reducer(response), None
+            except Exception as e:
+                return None, e
+
+        def follow(self, response, params, timeout=10):
+            """Re-issue the request behind response with other params."""
+            return self.session.get(response.url.split('?', 1)[0],
+                                    params=params,
+                                    headers=response.request.headers,
+                                    verify=False,
+                                    timeout=timeout)
+
+        def poll(self, token, api_requests, timeout=10):
+            """Return {request.name: result}, raising the first failure."""
+            headers = {'Content-type': 'application/json',
+                       'x-auth-token': token}
+            results = self.pool.map(self._fetch,
+                                    [(request, headers, timeout)
+                                     for request in api_requests])
+            polled = {}
+            for request, (result, error) in zip(api_requests, results):
+                if isinstance(error, TokenRejected):
+                    reject_token(token)
+                    raise requests.exceptions.HTTPError(
+                        '401 Unauthorized for %s' % error)
+                if error is not None:
+                    raise error
+                polled[request.name] = result
+            return polled
+
+    def count_listing(key, page_size):
+        """Build a reducer counting the items listed under key.
+
+        APIs which can count server-side (cinder's with_count) answer with a
+        'count' and the reducer returns it as is. Otherwise the listing is
+        paged through, see next_page, with the request's own filters and
+        page_size items a page, only ever looking at the items' ids. None is
+        returned if any page fails.
+        """
+        def reducer(response):
+            if not response.ok:
+                return None
+            body = response.json()
+            if 'count' in body:
+                return body['count']
+            params = dict(urlparse.parse_qsl(
+                urlparse.urlsplit(response.url).query))
+            count = 0
+            while True:
+                count += len(body[key])
+                params = next_page(body, key, params)
+                if params is None:
+                    return count
+                params['limit'] = page_size
+                response = get_api_poller().follow(response, params)
+                if not response.ok:
+                    return None
+                body = response.json()
+        return reducer
+
+    def get_api_poller():
+        global API_POLLER
+        # the pool's threads are only started once a plugin needs them
+        with API_POLLER_LOCK:
+            if API_POLLER is None:
+                API_POLLER = APIPoller()
+        return API_POLLER
 
-    graphiteSock.connect((graphite_host, int(graphite_port)))
-    graphiteSock.sendall(metric)
-    graphiteSock.close()
 
 try:
     logging.basicConfig(filename='/var/log/maas_plugins.log',
@@ -16,10 +16,14 @@
 
 import re
 
+from maas_common import configure_graphite
+from maas_common import flush_metrics
 from maas_common import metric
 from maas_common import metric_bool
+from maas_common import run_in_background
 from maas_common import status_err
 from maas_common import status_ok
+from maas_common import SPOOL_MAX_BYTES
 import memcache
 
 import collectd
@@ -40,8 +44,11 @@ def configure_callback(conf):
     ip = None
     port = 11211
     interval = 10
+    timeout = 10
     graphite_host = None
     graphite_port = None
+    graphite_protocol = 'plaintext'
+    graphite_spool_size = SPOOL_MAX_BYTES
 
     for node in conf.children:
         key = node.key
@@ -51,12 +58,18 @@ def configure_callback(conf):
             ip = val
         elif key == 'interval':
             interval = val
+        elif key == 'timeout':
+            timeout = val
         elif key == 'port':  # memcached port.
             port == port
         elif key == 'graphite_host':
             graphite_host = val
         elif key == 'graphite_port':
             graphite_port = val
+        elif key == 'graphite_protocol':
+            graphite_protocol = val
+        elif key == 'graphite_spool_size':
+            graphite_spool_size = val
         else:
             collectd.warning('memcached_status: Unknown config key: {}'
                              .format(key))
@@ -65,8 +78,11 @@ def configure_callback(conf):
     CONFIGS['ip'] = ip
     CONFIGS['port'] = port
     CONFIGS['interval'] = interval
+    CONFIGS['timeout'] = timeout
     CONFIGS['graphite_host'] = graphite_host
     CONFIGS['graphite_port'] = graphite_port
+    configure_graphite(graphite_host, graphite_port, graphite_protocol,
+                       graphite_spool_size)
 
 
 def item_stats(host, port):
@@ -114,8 +130,10 @@ def main():
                     graphite_host=CONFIGS['graphite_host'],
                     graphite_port=CONFIGS['graphite_port'])
         raise
+    finally:
+        flush_metrics()
 
 
 # register callbacks
 collectd.register_config(configure_callback)
-collectd.register_read(main)
+collectd.register_read(run_in_background(PLUGIN, main, CONFIGS))
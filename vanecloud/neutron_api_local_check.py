@@ -16,25 +16,42 @@
 
 import time
 
-from maas_common import get_neutron_client
+from maas_common import APIRequest
+from maas_common import configure_graphite
+from maas_common import flush_metrics
+from maas_common import get_api_poller
+from maas_common import get_auth_details
+from maas_common import get_auth_ref
+from maas_common import get_endpoint_type
+from maas_common import get_endpoint_url_for_service
+from maas_common import get_keystone_client
 from maas_common import metric
 from maas_common import metric_bool
+from maas_common import run_in_background
 from maas_common import status_err
 from maas_common import status_ok
-from neutronclient.client import exceptions as exc
+from maas_common import SPOOL_MAX_BYTES
+from requests import exceptions as exc
 
 import collectd
 
 CONFIGS = {}
 PLUGIN = 'neutron_api_local_check'
+INVENTORY = ['networks', 'routers', 'subnets']
+# the last inventory counts and when they were fetched
+INVENTORY_CACHE = {'counts': None, 'updated': 0}
 
 
 def configure_callback(conf):
     """Receive configuration block"""
     ip = None
     interval = 10
+    timeout = 10
     graphite_host = None
     graphite_port = None
+    graphite_protocol = 'plaintext'
+    graphite_spool_size = SPOOL_MAX_BYTES
+    inventory_interval = 300
 
     for node in conf.children:
         key = node.key
@@ -44,10 +61,18 @@ def configure_callback(conf):
             ip = val
         elif key == 'interval':
             interval = val
+        elif key == 'timeout':
+            timeout = val
         elif key == 'graphite_host':
             graphite_host = val
         elif key == 'graphite_port':
             graphite_port = val
+        elif key == 'graphite_protocol':
+            graphite_protocol = val
+        elif key == 'graphite_spool_size':
+            graphite_spool_size = val
+        elif key == 'inventory_interval':
+            inventory_interval = int(val)
         else:
             collectd.warning('neutron_api_local_check: Unknown config key: {}'
                              .format(key))
@@ -55,40 +80,79 @@ def configure_callback(conf):
 
     CONFIGS['ip'] = ip
     CONFIGS['interval'] = interval
+    CONFIGS['timeout'] = timeout
     CONFIGS['graphite_host'] = graphite_host
     CONFIGS['graphite_port'] = graphite_port
+    CONFIGS['inventory_interval'] = inventory_interval
+    configure_graphite(graphite_host, graphite_port, graphite_protocol,
+                       graphite_spool_size)
+
+
+def count_ids(key):
+    """Build a reducer counting the items of a fields=id listing."""
+    def reducer(response):
+        if not response.ok:
+            return None
+        return len(response.json()[key])
+    return reducer
+
+
+def get_inventory(endpoint):
+    """Return {resource: count}, refetched every inventory_interval.
+
+    Networks, routers and subnets change far less often than the API is
+    probed, so their counts are cached between cycles. When refreshed they
+    are listed at the same time with only their ids. None is returned if
+    any listing failed.
+    """
+    if (INVENTORY_CACHE['counts'] is not None and
+            time.time() - INVENTORY_CACHE['updated'] <
+            CONFIGS['inventory_interval']):
+        return INVENTORY_CACHE['counts']
+
+    auth_token = get_keystone_client(get_auth_ref()).auth_token
+    counts = get_api_poller().poll(auth_token, [
+        APIRequest(key, '%s/v2.0/%s' % (endpoint, key), {'fields': 'id'},
+                   count_ids(key))
+        for key in INVENTORY
+    ], timeout=10)
+    if None in counts.values():
+        return None
+
+    INVENTORY_CACHE['counts'] = counts
+    INVENTORY_CACHE['updated'] = time.time()
+    return counts
 
 
 def check():
     try:
-        NETWORK_ENDPOINT = 'http://{ip}:9696'.format(ip=CONFIGS['ip'])
+        if CONFIGS['ip']:
+            NETWORK_ENDPOINT = 'http://{ip}:9696'.format(ip=CONFIGS['ip'])
+        else:
+            NETWORK_ENDPOINT = get_endpoint_url_for_service(
+                'network', get_auth_ref(),
+                get_endpoint_type(get_auth_details())).rstrip('/')
 
         try:
-            if CONFIGS['ip']:
-                neutron = get_neutron_client(endpoint_url=NETWORK_ENDPOINT)
-            else:
-                neutron = get_neutron_client()
-
-            is_up = True
-        # if we get a NeutronClientException don't bother sending
-        # any other metric The API IS DOWN
-        except exc.NeutronClientException:
+            # time something arbitrary
+            auth_token = get_keystone_client(get_auth_ref()).auth_token
+            r = get_api_poller().poll(auth_token, [
+                APIRequest('agents', '%s/v2.0/agents' % NETWORK_ENDPOINT,
+                           {'fields': 'id'}, None)
+            ], timeout=10)['agents']
+            is_up = r.ok
+
+            # gather some metrics
+            if is_up:
+                inventory = get_inventory(NETWORK_ENDPOINT)
+                is_up = inventory is not None
+        # if the API doesn't answer don't bother sending any other metric,
+        # the API IS DOWN
+        except (exc.ConnectionError, exc.HTTPError, exc.Timeout):
             is_up = False
         # Any other exception presumably isn't an API error
         except Exception as e:
             status_err(str(e))
-        else:
-            # time something arbitrary
-            start = time.time()
-            neutron.list_agents()
-            end = time.time()
-            milliseconds = (end - start) * 1000
-
-            # gather some metrics
-            networks = len(neutron.list_networks()['networks'])
-            agents = len(neutron.list_agents()['agents'])
-            routers = len(neutron.list_routers()['routers'])
-            subnets = len(neutron.list_subnets()['subnets'])
 
         status_ok()
         metric_bool(PLUGIN, 'neutron_api_local_status', is_up,
@@ -96,21 +160,23 @@ def check():
                     graphite_port=CONFIGS['graphite_port'])
         # only want to send other metrics if api is up
         if is_up:
+            milliseconds = r.elapsed.total_seconds() * 1000
+            agents = len(r.json()['agents'])
             metric(PLUGIN,
                    'neutron_api_local_response_time',
                    '%.3f' % milliseconds,
                    graphite_host=CONFIGS['graphite_host'],
                    graphite_port=CONFIGS['graphite_port'])
-            metric(PLUGIN, 'neutron_networks', networks,
+            metric(PLUGIN, 'neutron_networks', inventory['networks'],
                    graphite_host=CONFIGS['graphite_host'],
                    graphite_port=CONFIGS['graphite_port'])
             metric(PLUGIN, 'neutron_agents', agents,
                    graphite_host=CONFIGS['graphite_host'],
                    graphite_port=CONFIGS['graphite_port'])
-            metric(PLUGIN, 'neutron_routers', routers,
+            metric(PLUGIN, 'neutron_routers', inventory['routers'],
                    graphite_host=CONFIGS['graphite_host'],
                    graphite_port=CONFIGS['graphite_port'])
-            metric(PLUGIN, 'neutron_subnets', subnets,
+            metric(PLUGIN, 'neutron_subnets', inventory['subnets'],
                    graphite_host=CONFIGS['graphite_host'],
                    graphite_port=CONFIGS['graphite_port'])
     except:
@@ -118,8 +184,10 @@ def check():
                     graphite_host=CONFIGS['graphite_host'],
                     graphite_port=CONFIGS['graphite_port'])
         raise
+    finally:
+        flush_metrics()
 
 
 # register callbacks
 collectd.register_config(configure_callback)
-collectd.register_read(check)
+collectd.register_read(run_in_background(PLUGIN, check, CONFIGS))
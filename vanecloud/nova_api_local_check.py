@@ -17,27 +17,51 @@
 import collections
 import time
 
+from maas_common import APIRequest
+from maas_common import configure_graphite
+from maas_common import flush_metrics
+from maas_common import get_api_poller
+from maas_common import get_auth_details
 from maas_common import get_auth_ref
+from maas_common import get_endpoint_type
+from maas_common import get_endpoint_url_for_service
 from maas_common import get_keystone_client
-from maas_common import get_nova_client
 from maas_common import metric
 from maas_common import metric_bool
+from maas_common import next_page
+from maas_common import run_in_background
 from maas_common import status_err
 from maas_common import status_ok
-from novaclient.client import exceptions as exc
+from maas_common import SPOOL_MAX_BYTES
+from requests import exceptions as exc
 import collectd
 
 CONFIGS = {}
 SERVER_STATUSES = ['ACTIVE', 'STOPPED', 'ERROR']
 PLUGIN = 'nova_api_local_check'
 
+# server id -> status of every instance in the cloud, and how many are in
+# each status, kept up to date between polls by sync_servers()
+SERVERS = {}
+STATUS_COUNT = collections.Counter()
+SYNC = {'last': None, 'full': None}
+# seconds subtracted from the previous poll when asking for changes, to
+# cover clock skew between us and nova
+CHANGES_SINCE_OVERLAP = 5
+
 
 def configure_callback(conf):
     """Receive configuration block"""
     ip = None
     interval = 10
+    timeout = 10
     graphite_host = None
     graphite_port = None
+    graphite_protocol = 'plaintext'
+    graphite_spool_size = SPOOL_MAX_BYTES
+    incremental_sync = True
+    full_sync_interval = 3600
+    page_size = 1000
 
     for node in conf.children:
         key = node.key
@@ -47,10 +71,22 @@ def configure_callback(conf):
             ip = val
         elif key == 'interval':
             interval = val
+        elif key == 'timeout':
+            timeout = val
         elif key == 'graphite_host':
             graphite_host = val
         elif key == 'graphite_port':
             graphite_port = val
+        elif key == 'graphite_protocol':
+            graphite_protocol = val
+        elif key == 'graphite_spool_size':
+            graphite_spool_size = val
+        elif key == 'incremental_sync':
+            incremental_sync = str(val) in ['True', 'true']
+        elif key == 'full_sync_interval':
+            full_sync_interval = val
+        elif key == 'page_size':
+            page_size = int(val)
         else:
             collectd.warning('nova_api_local_check: Unknown config key: {}'
                              .format(key))
@@ -60,42 +96,118 @@ def configure_callback(conf):
     CONFIGS['ip'] = ip
     CONFIGS['auth_ref'] = auth_ref
     CONFIGS['interval'] = interval
+    CONFIGS['timeout'] = timeout
     CONFIGS['graphite_host'] = graphite_host
     CONFIGS['graphite_port'] = graphite_port
+    CONFIGS['incremental_sync'] = incremental_sync
+    CONFIGS['full_sync_interval'] = full_sync_interval
+    CONFIGS['page_size'] = page_size
+    configure_graphite(graphite_host, graphite_port, graphite_protocol,
+                       graphite_spool_size)
+
+
+def set_server_status(server_id, status):
+    old = SERVERS.pop(server_id, None)
+    if old is not None:
+        STATUS_COUNT[old] -= 1
+    if status is not None:
+        SERVERS[server_id] = status
+        STATUS_COUNT[status] += 1
+
+
+def iter_servers(auth_token, endpoint, search_opts):
+    """Yield servers one page of page_size at a time using limit/marker.
+
+    Only a single page of servers is decoded at once, however many
+    instances the cloud has. Nova caps limit at osapi_max_limit, so pages
+    are followed through servers_links rather than stopping at the first
+    one shorter than page_size.
+    """
+    params = dict(search_opts, limit=CONFIGS['page_size'])
+    response = get_api_poller().poll(auth_token, [
+        APIRequest('servers', '%s/servers/detail' % endpoint, params, None)
+    ], timeout=10)['servers']
+    while True:
+        response.raise_for_status()
+        body = response.json()
+        for server in body['servers']:
+            yield server
+        params = next_page(body, 'servers', params)
+        if params is None:
+            return
+        response = get_api_poller().follow(response, params)
+
+
+def sync_servers(auth_token, endpoint):
+    """Bring SERVERS and STATUS_COUNT up to date with nova.
+
+    The first poll, and every full_sync_interval after that, lists every
+    server. In between only the servers changed since the previous poll are
+    fetched, deleted ones included, so a poll costs O(changes) rather than
+    O(instances).
+    """
+    started = time.time()
+    if not CONFIGS['incremental_sync']:
+        # nothing to remember between polls, so just fold each page into
+        # the counters
+        STATUS_COUNT.clear()
+        for server in iter_servers(auth_token, endpoint, {'all_tenants': 1}):
+            STATUS_COUNT[server['status']] += 1
+        return STATUS_COUNT
+
+    if (SYNC['last'] is None or
+            started - SYNC['full'] >= CONFIGS['full_sync_interval']):
+        SERVERS.clear()
+        STATUS_COUNT.clear()
+        for server in iter_servers(auth_token, endpoint, {'all_tenants': 1}):
+            set_server_status(server['id'], server['status'])
+        SYNC['full'] = started
+    else:
+        since = time.strftime(
+            '%Y-%m-%dT%H:%M:%SZ',
+            time.gmtime(SYNC['last'] - CHANGES_SINCE_OVERLAP))
+        servers = iter_servers(auth_token, endpoint,
+                               {'all_tenants': 1, 'changes-since': since})
+        for server in servers:
+            if server['status'] == 'DELETED':
+                set_server_status(server['id'], None)
+            else:
+                set_server_status(server['id'], server['status'])
+    SYNC['last'] = started
+    return STATUS_COUNT
 
 
 def check():
     try:
         keystone = get_keystone_client(CONFIGS['auth_ref'])
-        tenant_id = keystone.tenant_id
+        auth_token = keystone.auth_token
 
-        COMPUTE_ENDPOINT = (
-            'http://{ip}:8774/v2/{tenant_id}'.format(ip=CONFIGS['ip'],
-                                                     tenant_id=tenant_id)
-        )
+        if CONFIGS['ip']:
+            COMPUTE_ENDPOINT = (
+                'http://{ip}:8774/v2/{tenant_id}'.format(
+                    ip=CONFIGS['ip'], tenant_id=keystone.tenant_id)
+            )
+        else:
+            COMPUTE_ENDPOINT = get_endpoint_url_for_service(
+                'compute', get_auth_ref(),
+                get_endpoint_type(get_auth_details())).rstrip('/')
 
         try:
-            if CONFIGS['ip']:
-                nova = get_nova_client(bypass_url=COMPUTE_ENDPOINT)
-            else:
-                nova = get_nova_client()
+            # time something arbitrary
+            r = get_api_poller().poll(auth_token, [
+                APIRequest('services', '%s/os-services' % COMPUTE_ENDPOINT,
+                           None, None)
+            ], timeout=10)['services']
+            is_up = r.ok
 
-            is_up = True
-        except exc.ClientException:
+            # gather some metrics
+            if is_up:
+                status_count = sync_servers(auth_token, COMPUTE_ENDPOINT)
+        except (exc.ConnectionError, exc.HTTPError, exc.Timeout):
             is_up = False
         # Any other exception presumably isn't an API error
         except Exception as e:
             status_err(str(e))
-        else:
-            # time something arbitrary
-            start = time.time()
-            nova.services.list()
-            end = time.time()
-            milliseconds = (end - start) * 1000
-
-            servers = nova.servers.list(search_opts={'all_tenants': 1})
-            # gather some metrics
-            status_count = collections.Counter([s.status for s in servers])
 
         status_ok()
         metric_bool(PLUGIN, 'nova_api_local_status', is_up,
@@ -104,6 +216,7 @@ def check():
                     graphite_port=CONFIGS['graphite_port'])
         # only want to send other metrics if api is up
         if is_up:
+            milliseconds = r.elapsed.total_seconds() * 1000
             metric(PLUGIN,
                    'nova_api_local_response_time',
                    '%.3f' % milliseconds,
@@ -122,8 +235,10 @@ def check():
                     graphite_host=CONFIGS['graphite_host'],
                     graphite_port=CONFIGS['graphite_port'])
         raise
+    finally:
+        flush_metrics()
 
 
 # register callbacks
 collectd.register_config(configure_callback)
-collectd.register_read(check)
+collectd.register_read(run_in_background(PLUGIN, check, CONFIGS))
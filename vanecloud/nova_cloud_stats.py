@@ -16,13 +16,19 @@
 
 import collections
 
+from maas_common import configure_graphite
+from maas_common import flush_metrics
 from maas_common import get_auth_ref
 from maas_common import get_keystone_client
 from maas_common import get_nova_client
 from maas_common import metric
 from maas_common import metric_bool
+from maas_common import reject_token
+from maas_common import run_in_background
 from maas_common import status_err
 from maas_common import status_ok
+from maas_common import SPOOL_MAX_BYTES
+from novaclient.client import exceptions as exc
 
 import collectd
 
@@ -67,8 +73,11 @@ def configure_callback(conf):
     """Receive configuration block"""
     ip = None
     interval = 10
+    timeout = 10
     graphite_host = None
     graphite_port = None
+    graphite_protocol = 'plaintext'
+    graphite_spool_size = SPOOL_MAX_BYTES
 
     for node in conf.children:
         key = node.key
@@ -78,10 +87,16 @@ def configure_callback(conf):
             ip = val
         elif key == 'interval':
             interval = val
+        elif key == 'timeout':
+            timeout = val
         elif key == 'graphite_host':
             graphite_host = val
         elif key == 'graphite_port':
             graphite_port = val
+        elif key == 'graphite_protocol':
+            graphite_protocol = val
+        elif key == 'graphite_spool_size':
+            graphite_spool_size = val
         else:
             collectd.warning('nova_cloud_stats: Unknown config key: {}'
                              .format(key))
@@ -91,8 +106,11 @@ def configure_callback(conf):
     CONFIGS['ip'] = ip
     CONFIGS['auth_ref'] = auth_ref
     CONFIGS['interval'] = interval
+    CONFIGS['timeout'] = timeout
     CONFIGS['graphite_host'] = graphite_host
     CONFIGS['graphite_port'] = graphite_port
+    configure_graphite(graphite_host, graphite_port, graphite_protocol,
+                       graphite_spool_size)
 
 
 def check():
@@ -115,15 +133,20 @@ def check():
             status_err(str(e))
         else:
             # get some cloud stats
-            stats = nova.hypervisor_stats.statistics()
-            cloud_stats = collections.defaultdict(dict)
-            for metric_name, vals in stats_mapping.iteritems():
-                cloud_stats[metric_name]['value'] = \
-                    getattr(stats, vals['stat_name'])
-                cloud_stats[metric_name]['unit'] = \
-                    vals['unit']
-                cloud_stats[metric_name]['type'] = \
-                    vals['type']
+            try:
+                stats = nova.hypervisor_stats.statistics()
+                cloud_stats = collections.defaultdict(dict)
+                for metric_name, vals in stats_mapping.iteritems():
+                    cloud_stats[metric_name]['value'] = \
+                        getattr(stats, vals['stat_name'])
+                    cloud_stats[metric_name]['unit'] = \
+                        vals['unit']
+                    cloud_stats[metric_name]['type'] = \
+                        vals['type']
+            except exc.Unauthorized:
+                # the cached client's token was revoked before it expired
+                reject_token()
+                raise
 
         status_ok()
         for metric_name in cloud_stats.iterkeys():
@@ -143,8 +166,10 @@ def check():
                     graphite_host=CONFIGS['graphite_host'],
                     graphite_port=CONFIGS['graphite_port'])
         raise
+    finally:
+        flush_metrics()
 
 
 # register callbacks
 collectd.register_config(configure_callback)
-collectd.register_read(check)
+collectd.register_read(run_in_background(PLUGIN, check, CONFIGS))
@@ -14,13 +14,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from maas_common import configure_graphite
+from maas_common import flush_metrics
 from maas_common import get_auth_ref
 from maas_common import get_keystone_client
 from maas_common import get_nova_client
 from maas_common import metric
 from maas_common import metric_bool
+from maas_common import reject_token
+from maas_common import run_in_background
 from maas_common import status_err
 from maas_common import status_ok
+from maas_common import SPOOL_MAX_BYTES
+from novaclient.client import exceptions as exc
 import collectd
 from collections import defaultdict as dict
 
@@ -33,8 +39,11 @@ def configure_callback(conf):
     ip = None
     host = None
     interval = 10
+    timeout = 10
     graphite_host = None
     graphite_port = None
+    graphite_protocol = 'plaintext'
+    graphite_spool_size = SPOOL_MAX_BYTES
 
     for node in conf.children:
         key = node.key
@@ -44,12 +53,18 @@ def configure_callback(conf):
             ip = val
         elif key == 'interval':
             interval = val
+        elif key == 'timeout':
+            timeout = val
         elif key == 'host':  # Only return metrics for specified host
             host == host
         elif key == 'graphite_host':
             graphite_host = val
         elif key == 'graphite_port':
             graphite_port = val
+        elif key == 'graphite_protocol':
+            graphite_protocol = val
+        elif key == 'graphite_spool_size':
+            graphite_spool_size = val
         else:
             collectd.warning('nova_service_check: Unknown config key: {}'
                              .format(key))
@@ -60,8 +75,11 @@ def configure_callback(conf):
     CONFIGS['host'] = host
     CONFIGS['auth_ref'] = auth_ref
     CONFIGS['interval'] = interval
+    CONFIGS['timeout'] = timeout
     CONFIGS['graphite_host'] = graphite_host
     CONFIGS['graphite_port'] = graphite_port
+    configure_graphite(graphite_host, graphite_port, graphite_protocol,
+                       graphite_spool_size)
 
 
 def check():
@@ -84,10 +102,15 @@ def check():
             status_err(str(e))
 
         # gather nova service states
-        if CONFIGS['host']:
-            services = nova.services.list(host=CONFIGS['host'])
-        else:
-            services = nova.services.list()
+        try:
+            if CONFIGS['host']:
+                services = nova.services.list(host=CONFIGS['host'])
+            else:
+                services = nova.services.list()
+        except exc.Unauthorized:
+            # the cached client's token was revoked before it expired
+            reject_token(auth_token)
+            raise
 
         if len(services) == 0:
             status_err("No host(s) found in the service list")
@@ -127,8 +150,10 @@ def check():
                     graphite_host=CONFIGS['graphite_host'],
                     graphite_port=CONFIGS['graphite_port'])
         raise
+    finally:
+        flush_metrics()
 
 
 # register callbacks
 collectd.register_config(configure_callback)
-collectd.register_read(check)
+collectd.register_read(run_in_background(PLUGIN, check, CONFIGS))